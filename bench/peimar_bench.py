@@ -0,0 +1,363 @@
+"""Benchmark offline del bridge Peimar.
+
+Avvia un finto portale Peimar in locale (latenza, errori e dimensione dei payload
+configurabili), sostituisce il client MQTT con un registratore in-process e guida
+PeimarTester attraverso avvio, cicli di polling e sincronizzazione notturna dello storico.
+
+Uso:
+    python bench/peimar_bench.py --cycles 20 --latency 0.2 --devices 2
+    python bench/peimar_bench.py --json      # risultati in formato JSON
+    python bench/peimar_bench.py --local     # lettura in LAN da un simulatore Modbus TCP
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import socket
+import socketserver
+import statistics
+import struct
+import sys
+import tempfile
+import threading
+import time
+import types
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "peimar_bridge"))
+
+
+class FakePortal():
+    """Finto peimar-portal.com: risponde agli endpoint usati dal bridge e conta le richieste."""
+
+    def __init__(self, latency=0.0, error_rate=0.0, raw_records=1):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.raw_records = raw_records
+        self.installed = None   # "YYYY-MM-DD": giorni precedenti senza dati
+        self.outage = False     # Proxy guasto: ogni richiesta riceve una pagina HTML 502
+        self.expired = False    # Sessione scaduta: pagina di login HTML fino al prossimo login
+        self.update_ts = int(time.time() * 1000)
+        self.requests = 0
+        self.by_endpoint = {}
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.handler())
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+    def release(self):
+        # Simula il rilascio di un nuovo dato da parte dell'inverter
+        self.update_ts += 300000
+
+    def reset_counters(self):
+        with self.lock:
+            self.requests = 0
+            self.by_endpoint = {}
+
+    def live(self):
+        return {"storeDevicePower": {"updateDate": self.update_ts, "solarPower": 3.2, "gridPower": 850,
+                                     "gridDirection": 1, "batteryDirection": -1}}
+
+    def raw(self, params):
+        record = {"nowPrower": 3200, "pV1Power": 1700, "pV2Power": 1500, "pV1Volt": 310.4, "pV2Volt": 305.1,
+                  "pV1Curr": 5.4, "pV2Curr": 4.9, "todayPVEnergy": 12.3, "batCapicity": 100, "batEnergyPercent": "76%",
+                  "batPower": 1200, "batVolt": 52.1, "batCurr": 23.0, "todayBatChgEnergy": 4.1,
+                  "todayBatDisEnergy": 1.2, "totalBatChgEnergy": 812.0, "totalBatDisEnergy": 790.5,
+                  "totalLoadPowerWatt": 1150, "todayLoadEnergyStr": "9,8kWh", "todayFeedInEnergy": 0.4,
+                  "todaySellEnergy": 3.3, "rGridVolt": 231.2, "rGridCurr": 3.7, "rGridFreq": 50.01,
+                  "deviceTemp": 41.5, "dataTime": self.update_ts}
+        size = int(params.get("pageSize", [self.raw_records])[0])
+        first = (int(params.get("pageNum", ["1"])[0]) - 1) * size
+        count = max(0, min(size, self.raw_records - first))
+        return {"list": [dict(record, dataTime=self.update_ts - (first + i) * 300000) for i in range(count)],
+                "total": self.raw_records}
+
+    def chart(self, params):
+        # Prima della data di installazione il portale non ha dati giornalieri
+        giorno = params.get("chartDay", [""])[0]
+        if self.installed and params.get("chartDateType") == ["1"] and giorno and giorno < self.installed:
+            return {"viewBean": {}}
+        return {"viewBean": {"pvElec": f"{random.uniform(100, 900):.1f}", "useElec": "420,5",
+                             "buyElec": "120.0", "sellElec": "210.0"}}
+
+    def handler(self):
+        portal = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def reply(self):
+                url = urlparse(self.path)
+                endpoint = url.path.rsplit("/", 1)[-1]
+                params = parse_qs(url.query)
+                with portal.lock:
+                    portal.requests += 1
+                    portal.by_endpoint[endpoint] = portal.by_endpoint.get(endpoint, 0) + 1
+                if portal.latency:
+                    time.sleep(portal.latency)
+                if random.random() < portal.error_rate:
+                    self.send_response(500)
+                    self.end_headers()
+                    return
+                if portal.outage or (portal.expired and endpoint != "login"):
+                    page = b"<html><body>Bad Gateway</body></html>" if portal.outage else b"<html><form id='login'></form></html>"
+                    self.send_response(502 if portal.outage else 200)
+                    self.send_header("Content-Type", "text/html")
+                    self.send_header("Content-Length", str(len(page)))
+                    self.end_headers()
+                    self.wfile.write(page)
+                    return
+                if endpoint == "login":
+                    portal.expired = False
+                    body = {"success": True}
+                elif endpoint == "getPlantDetailInfo":
+                    body = {"plantDetail": {"plantName": "Bench", "capacity": 6.0}}
+                elif endpoint == "getStoreOrAcDevicePowerInfo":
+                    body = portal.live()
+                elif endpoint == "findRawdataPageList":
+                    body = portal.raw(params)
+                elif endpoint == "getPlantDetailChart2":
+                    body = portal.chart(params)
+                else:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                data = json.dumps(body).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json;charset=UTF-8")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = reply
+            do_POST = reply
+
+        return Handler
+
+
+class ModbusSimulator():
+    """Data-logger Modbus TCP simulato: espone i valori di `values` secondo la mappa registri del bridge."""
+
+    def __init__(self, registers, values):
+        self.words = {}
+        for _, field, address, size, scale, signed, _ in registers:
+            if field not in values:
+                continue   # Registri condivisi tra più campi (es. solarPower/nowPrower): vale quello fornito
+            value = round(values[field] / scale) % (1 << (16 * size))
+            for i in range(size):
+                self.words[address + i] = value >> (16 * (size - 1 - i)) & 0xFFFF
+        self.requests = 0
+        self.clients = set()
+        self.server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), self.handler())
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        # Come un data-logger spento: oltre a non accettare connessioni chiude quelle aperte
+        self.server.shutdown()
+        self.server.server_close()
+        for client in list(self.clients):
+            try:
+                client.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def handler(self):
+        sim = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                sim.clients.add(self.request)
+                while True:
+                    header = self.request.recv(12)
+                    if len(header) < 12:
+                        return
+                    tid, _, _, unit, function, address, count = struct.unpack(">HHHBBHH", header)
+                    sim.requests += 1
+                    data = struct.pack(f">{count}H", *(sim.words.get(address + i, 0) for i in range(count)))
+                    self.request.sendall(struct.pack(">HHHBBB", tid, 0, 3 + len(data), unit, function, len(data)) + data)
+
+        return Handler
+
+
+class MqttRecorder():
+    """Sostituto in-process di paho: registra i messaggi invece di inviarli a un broker."""
+
+    def __init__(self):
+        self.messages = []
+        self.lock = threading.Lock()
+        self.connected = True
+
+    def is_connected(self):
+        return self.connected
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        if not self.connected:
+            return types.SimpleNamespace(rc=4)   # MQTT_ERR_NO_CONN
+        with self.lock:
+            self.messages.append((topic, payload, retain))
+        return types.SimpleNamespace(rc=0)
+
+    def subscribe(self, *args, **kwargs):
+        pass
+
+    def count(self):
+        with self.lock:
+            return len(self.messages)
+
+
+def measure(portal, recorder, fn):
+    portal.reset_counters()
+    published = recorder.count()
+    start = time.perf_counter()
+    fn()
+    return {"seconds": time.perf_counter() - start, "requests": portal.requests,
+            "mqtt": recorder.count() - published}
+
+
+def summary(samples):
+    durations = [s["seconds"] for s in samples]
+    return {
+        "cycles": len(samples),
+        "latency_mean_ms": round(statistics.mean(durations) * 1000, 1),
+        "latency_max_ms": round(max(durations) * 1000, 1),
+        "requests_per_cycle": round(statistics.mean(s["requests"] for s in samples), 2),
+        "mqtt_per_cycle": round(statistics.mean(s["mqtt"] for s in samples), 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark offline del bridge Peimar")
+    parser.add_argument("--cycles", type=int, default=10, help="cicli di polling per inverter")
+    parser.add_argument("--devices", type=int, default=1, help="numero di inverter simulati")
+    parser.add_argument("--latency", type=float, default=0.05, help="latenza del portale per richiesta (s)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="frazione di richieste che rispondono 500")
+    parser.add_argument("--raw-records", type=int, default=1, help="record restituiti da findRawdataPageList")
+    parser.add_argument("--daily", action="store_true", help="storico giornaliero (history_daily) invece che mensile")
+    parser.add_argument("--local", action="store_true", help="inverter letti in LAN da un simulatore Modbus")
+    parser.add_argument("--aggregate", type=int, nargs="*", default=[], metavar="MIN",
+                        help="finestre (minuti) delle statistiche dei sensori di potenza")
+    parser.add_argument("--json", action="store_true", help="stampa i risultati in JSON")
+    args = parser.parse_args()
+
+    portal = FakePortal(args.latency, args.error_rate, args.raw_records).start()
+    import peimar
+    record = dict(portal.raw({})["list"][0], **portal.live()["storeDevicePower"])
+    values = {field: peimar.to_float(value) for field, value in record.items()}
+    modbus = ModbusSimulator(peimar.MODBUS_REGISTERS, dict(values, gridPower=-850, batPower=-1200)).start()
+    workdir = tempfile.mkdtemp(prefix="peimar-bench-")
+    os.environ["PEIMAR_DATA_DIR"] = workdir
+    os.environ["PEIMAR_SHARE_DIR"] = workdir
+    os.environ["PEIMAR_PORTAL_URL"] = portal.url
+    with open(os.path.join(workdir, "options.json"), "w") as f:
+        json.dump({
+            "peimar_user": "bench", "peimar_pass": "bench", "mqtt_host": "127.0.0.1",
+            "plants": [dict({"plant_uid": f"PLANT-{i}", "device_sn": f"BENCH{i:04d}"},
+                            **({"source": "modbus", "modbus_host": "127.0.0.1", "modbus_port": modbus.port} if args.local else {}))
+                       for i in range(args.devices)],
+            "poll_stagger": 0,
+            "aggregate_windows": args.aggregate,
+        }, f)
+
+    bridge = peimar.PeimarTester()
+    bridge.mqttc.loop_stop()
+    recorder = MqttRecorder()
+    bridge.mqttc = recorder
+    bridge.HISTORY_REQUEST_DELAY = 0
+    bridge.HISTORY_DAILY = args.daily
+    bridge.BACKFILL_RATE = 1000
+
+    results = {"params": vars(args)}
+    # Avvio reale (run() senza il ciclo infinito): avvio a caldo, login, discovery, primo polling e
+    # primo storico, finché restano job già scaduti nello scheduler
+    results["startup"] = measure(portal, recorder, lambda: (bridge.start(), bridge.scheduler.run_pending()))
+
+    def full_history():
+        for dev in bridge.devices:
+            storia, _ = bridge.sync_history(dev, {}, start_year=2022)
+            bridge.save_local_history(dev, storia)
+    results["history_full"] = measure(portal, recorder, full_history)
+
+    polling = "polling"
+    if args.local:
+        locali = []
+        for _ in range(args.cycles):
+            for dev in bridge.devices:
+                modbus.requests = 0
+                r = measure(portal, recorder, lambda: bridge.poll_local(dev))
+                locali.append(dict(r, requests=modbus.requests))
+        results["local_polling"] = summary(locali)
+        # Con la sorgente locale attiva il polling cloud non fa nulla: si misura invece il
+        # ripiego sul portale dopo che il data-logger smette di rispondere
+        modbus.stop()
+        for dev in bridge.devices:
+            for _ in range(bridge.LOCAL_MAX_FAILURES):
+                bridge.poll_local(dev)
+        polling = "fallback_polling"
+
+    cycles = []
+    for _ in range(args.cycles):
+        portal.release()
+        for dev in bridge.devices:
+            cycles.append(measure(portal, recorder, lambda: bridge.poll_live(dev)))
+    results[polling] = summary(cycles)
+
+    stale = [measure(portal, recorder, lambda: bridge.poll_live(dev)) for dev in bridge.devices]
+    results["stale_probe"] = summary(stale)
+
+    def nightly():
+        for dev in bridge.devices:
+            bridge.job_history(dev)
+    results["history_nightly"] = measure(portal, recorder, nightly)
+
+    def warm_start():
+        for dev in bridge.devices:
+            bridge.warm_start(dev)
+    results["warm_start"] = measure(portal, recorder, warm_start)
+
+    def raw_ingest():
+        for dev in bridge.devices:
+            bridge.ingest_raw(dev)
+    results["raw_ingest"] = measure(portal, recorder, raw_ingest)
+
+    results["peak_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    portal.stop()
+    if not args.local:
+        modbus.stop()
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print("\n" + "=" * 60)
+    print(f"{'BENCHMARK PEIMAR BRIDGE':^60}")
+    print("=" * 60)
+    for name in ("startup", "warm_start", "history_full", "history_nightly", "raw_ingest"):
+        r = results[name]
+        print(f"{name:<18} {r['seconds'] * 1000:9.1f} ms  {r['requests']:5d} richieste  {r['mqtt']:5d} MQTT")
+    for name in ("polling", "local_polling", "fallback_polling", "stale_probe"):
+        if name not in results:
+            continue
+        r = results[name]
+        print(f"{name:<18} {r['latency_mean_ms']:9.1f} ms (max {r['latency_max_ms']:.1f})  "
+              f"{r['requests_per_cycle']:5.2f} richieste/ciclo  {r['mqtt_per_cycle']:5.2f} MQTT/ciclo")
+    print(f"{'peak RSS':<18} {results['peak_rss_mb']:9.1f} MB")
+    print("=" * 60 + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,990 @@
 import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from datetime import date, datetime, timedelta
 import paho.mqtt.client as mqtt
 import json
 import time
 import os
+import heapq
+import random
+import contextlib
+import bisect
+import math
+import mmap
+import struct
+import hashlib
+import functools
+import itertools
+import threading
+import abc
+import collections
+import socket
+
+# Campi dei record raw che possono contenere l'orario di acquisizione (ms epoch o data ISO)
+RAW_TIME_KEYS = ("dataTime", "collectTime", "updateDate", "createTime")
+
+
+# Endpoint del portale monitorati dai sensori diagnostici
+PORTAL_ENDPOINTS = ("login", "getPlantDetailInfo", "getStoreOrAcDevicePowerInfo", "findRawdataPageList", "getPlantDetailChart2")
+
+# Topic discovery usati prima del supporto multi-inverter (senza seriale nell'object_id)
+LEGACY_DISCOVERY = (
+    "pv_solar_power", "pv_power_now", "pv_pv1_power", "pv_pv2_power", "pv_pv1_volt", "pv_pv2_volt",
+    "pv_pv1_current", "pv_pv2_current", "pv_energy_today", "battery_capacity", "battery_soc",
+    "battery_power_live", "battery_volt", "battery_current", "battery_today_charge_energy",
+    "battery_today_discharge_energy", "battery_battery_status", "house_load_live",
+    "house_energy_consumption_today", "house_import_today", "house_export_today", "grid_power",
+    "grid_grid_voltage", "grid_grid_current", "grid_grid_frequency", "grid_grid_status",
+    "inverter_deviceTemp", "status_last_update_time",
+)
+
+
+# =====================================================================================
+# Registro dei sensori: per ogni topic, da quale dizionario del portale si legge il valore,
+# come si converte e come si annuncia a Home Assistant. Discovery, pubblicazione e archivio
+# campioni derivano tutti da qui; i convertitori vengono compilati una sola volta all'avvio.
+# =====================================================================================
+
+# Caratteri da togliere (o sostituire) nei numeri testuali del portale: "9,8kWh", "76%", "850W"
+NUMBER_CLEANUP = str.maketrans({"%": None, "k": None, "W": None, "h": None, ",": "."})
+
+
+def to_float(value):
+    """Numero del portale (anche testuale) come float; 0.0 se mancante o non leggibile."""
+    if value is None: return 0.0
+    try:
+        if isinstance(value, str):
+            return float(value.translate(NUMBER_CLEANUP).strip())
+        return float(value)
+    except ValueError: return 0.0
+
+
+def round2(value):
+    # Tensioni, correnti, frequenze ed energie: float a 2 decimali, altrimenti il valore così com'è
+    try:
+        return round(float(value), 2)
+    except (TypeError, ValueError):
+        return value
+
+
+def percent(value):
+    # "76%" -> 76.0
+    if isinstance(value, str) and "%" in value:
+        return float(value.replace('%', '').replace(',', '.'))
+    return value
+
+
+def clock(value):
+    # Timestamp in millisecondi -> orario leggibile
+    return datetime.fromtimestamp(value / 1000.0).strftime('%H:%M:%S') if value else "N/D"
+
+
+def grid_status(live):
+    power = live.get("gridPower") or 0
+    if live.get("gridDirection") == -1 and power > 0:
+        return "Immissione"
+    if live.get("gridDirection") == 1 and power > 0:
+        return "Esportazione"
+    return "Riposo"
+
+
+def battery_status(live):
+    return {-1: "Batteria in carica", 1: "Batteria in scarica"}.get(live.get("batteryDirection"), "Batteria a riposo")
+
+
+class Sensor():
+    """Un sensore pubblicato: sorgente (live/raw), campo, unità, classi HA, convertitore e segno.
+
+    `field` None passa al convertitore l'intero dizionario (per gli stati calcolati da più campi).
+    `sign` è una coppia (sorgente, campo direzione): quando la direzione vale -1 il valore diventa negativo.
+    I sensori senza state_class sono testuali e non finiscono nello SampleStore.
+    """
+
+    def __init__(self, topic, name, source, field, unit="", dev_class=None, state_class="measurement",
+                 convert=None, sign=None, discovery=True):
+        self.topic = topic
+        self.name = name
+        self.source = source
+        self.field = field
+        self.unit = unit
+        self.dev_class = dev_class
+        self.state_class = state_class
+        self.convert = convert
+        self.sign = sign
+        self.discovery = discovery
+        # Campi del portale da cui dipende il valore (per sapere se un record isolato basta a calcolarlo)
+        self.requires = tuple(f for f in (field, sign and sign[1]) if f)
+
+    def accessor(self, sources):
+        """Funzione (tupla di dizionari nell'ordine di `sources`) -> valore convertito o None."""
+        index, field, convert = sources.index(self.source), self.field, self.convert
+        if field is None:
+            get = lambda dati: convert(dati[index])
+        elif convert is None:
+            get = lambda dati: dati[index].get(field)
+        else:
+            get = lambda dati: convert(dati[index].get(field))
+        if self.sign is None:
+            return get
+        sign_index, sign_field = sources.index(self.sign[0]), self.sign[1]
+
+        def signed(dati):
+            value = get(dati)
+            if value is not None and dati[sign_index].get(sign_field) == -1:
+                return -abs(value)
+            return value
+        return signed
+
+
+SENSORS = (
+    # ================== FOTOVOLTAICO =============================
+    Sensor("pv/solar_power", "Potenza Impianto", "live", "solarPower", "KW"),
+    Sensor("pv/power_now", "Potenza PV Live", "raw", "nowPrower", "W", "power"),
+    Sensor("pv/pv1_power", "Potenza S1 Live", "raw", "pV1Power", "W", "power"),
+    Sensor("pv/pv2_power", "Potenza S2 Live", "raw", "pV2Power", "W", "power"),
+    Sensor("pv/pv1_volt", "Tensione S1 Live", "raw", "pV1Volt", "V", "voltage", convert=round2),
+    Sensor("pv/pv2_volt", "Tensione S2 Live", "raw", "pV2Volt", "V", "voltage", convert=round2),
+    Sensor("pv/pv1_current", "Corrente S1 Live", "raw", "pV1Curr", "A", "current", convert=round2),
+    Sensor("pv/pv2_current", "Corrente S2 Live", "raw", "pV2Curr", "A", "current", convert=round2),
+    Sensor("pv/energy_today", "Energia Prodotta Oggi", "raw", "todayPVEnergy", "kWh", "energy", "total_increasing", round2),
+    # --- DETTAGLI BATTERIA ---
+    Sensor("battery/capacity", "Capacità Batteria", "raw", "batCapicity", "Ah"),
+    Sensor("battery/soc", "SOC Batteria", "raw", "batEnergyPercent", "%", "battery", convert=percent),
+    Sensor("battery/power_live", "Potenza Batteria Live", "raw", "batPower", "W", "power", sign=("live", "batteryDirection")),
+    Sensor("battery/volt", "Tensione Batteria", "raw", "batVolt", "V", "voltage", convert=round2),
+    Sensor("battery/current", "Corrente Batteria", "raw", "batCurr", "A", "current", convert=round2),
+    Sensor("battery/today_charge_energy", "Energia Caricata in Bat. Oggi", "raw", "todayBatChgEnergy", "kWh", "energy", "total_increasing", round2),
+    Sensor("battery/today_discharge_energy", "Energia Scaricata da Bat. Oggi", "raw", "todayBatDisEnergy", "kWh", "energy", "total_increasing", round2),
+    Sensor("battery/total_charge_energy", "Energia Caricata in Bat. Totale", "raw", "totalBatChgEnergy", "kWh", "energy", "total_increasing", round2, discovery=False),
+    Sensor("battery/total_discharge_energy", "Energia Scaricata da Bat. Totale", "raw", "totalBatDisEnergy", "kWh", "energy", "total_increasing", round2, discovery=False),
+    Sensor("battery/battery_status", "Stato Batteria", "live", None, state_class=None, convert=battery_status),
+    # ======= DETTAGLI CARICO CASA / RETE ===============================================================
+    Sensor("house/load_live", "Consumo Casa Live", "raw", "totalLoadPowerWatt", "W", "power"),
+    Sensor("house/energy_consumption_today", "Consumo Casa oggi", "raw", "todayLoadEnergyStr", "kWh", "energy", "total_increasing", to_float),
+    Sensor("house/import_today", "Energia Importata Oggi", "raw", "todayFeedInEnergy", "kWh", "energy", "total_increasing"),
+    Sensor("house/export_today", "Energia Esportata Oggi", "raw", "todaySellEnergy", "kWh", "energy", "total_increasing"),
+    Sensor("grid/power", "Potenza Rete Live", "live", "gridPower", "W", "power", sign=("live", "gridDirection")),
+    Sensor("grid/grid_voltage", "Tensione Rete Live", "raw", "rGridVolt", "V", "voltage", convert=round2),
+    Sensor("grid/grid_current", "Corrente Rete Live", "raw", "rGridCurr", "A", "current", convert=round2),
+    Sensor("grid/grid_frequency", "Frequenza Rete Live", "raw", "rGridFreq", "Hz", "frequency", convert=round2),
+    Sensor("grid/grid_status", "Stato Rete", "live", None, state_class=None, convert=grid_status),
+    # ========== INVERTER ===================================
+    Sensor("inverter/deviceTemp", "Temperatura Inverter", "raw", "deviceTemp", "°C", "temperature"),
+    # ==================== STATUS =========================================================
+    Sensor("status/last_update_time", "Ultimo Aggiornamento", "live", "updateDate", state_class=None, convert=clock),
+)
+
+# Dizionari (e quindi endpoint) da cui process_and_publish legge i valori pubblicati
+PUBLISH_SOURCES = tuple(dict.fromkeys(source for s in SENSORS for source in (s.source, s.sign and s.sign[0]) if source))
+
+# Accessori precompilati (topic, funzione) usati a ogni ciclo di pubblicazione; ricevono la tupla (live, raw)
+SENSOR_ACCESSORS = tuple((s.topic, s.accessor(("live", "raw"))) for s in SENSORS)
+
+# Topic numerici archiviati nello SampleStore (gli stati testuali e l'orario sono esclusi)
+SAMPLE_FIELDS = tuple(s.topic for s in SENSORS if s.state_class)
+
+# Mappa registri Modbus del data-logger per la lettura in LAN: (sorgente, campo del portale, registro,
+# parole da 16 bit, scala, con segno, campo direzione). I valori con campo direzione sono letti con segno
+# (positivo = esportazione / scarica) e convertiti in modulo + direzione come fa il portale.
+# Mappa di riferimento per logger compatibili Sofar: se diversa, va sovrascritta con MODBUS_MAP_PATH.
+MODBUS_REGISTERS = (
+    ("live", "solarPower", 0x05C4, 1, 0.1, False, None),   # kW
+    ("raw", "nowPrower", 0x05C4, 1, 100, False, None),
+    ("raw", "pV1Volt", 0x0584, 1, 0.1, False, None),
+    ("raw", "pV1Curr", 0x0585, 1, 0.01, False, None),
+    ("raw", "pV1Power", 0x0586, 1, 10, False, None),
+    ("raw", "pV2Volt", 0x0587, 1, 0.1, False, None),
+    ("raw", "pV2Curr", 0x0588, 1, 0.01, False, None),
+    ("raw", "pV2Power", 0x0589, 1, 10, False, None),
+    ("raw", "rGridFreq", 0x0484, 1, 0.01, False, None),
+    ("live", "gridPower", 0x0488, 1, 10, True, "gridDirection"),
+    ("raw", "rGridVolt", 0x048D, 1, 0.1, False, None),
+    ("raw", "rGridCurr", 0x048E, 1, 0.01, False, None),
+    ("raw", "totalLoadPowerWatt", 0x04AF, 1, 10, False, None),
+    ("raw", "batVolt", 0x0604, 1, 0.1, False, None),
+    ("raw", "batCurr", 0x0605, 1, 0.01, True, None),
+    ("raw", "batPower", 0x0606, 1, 10, True, "batteryDirection"),
+    ("raw", "deviceTemp", 0x0607, 1, 1, True, None),
+    ("raw", "batEnergyPercent", 0x0608, 1, 1, False, None),
+    ("raw", "todayPVEnergy", 0x0685, 2, 0.01, False, None),
+    ("raw", "todayLoadEnergyStr", 0x0689, 2, 0.01, False, None),
+    ("raw", "todaySellEnergy", 0x068D, 2, 0.01, False, None),
+    ("raw", "todayFeedInEnergy", 0x0691, 2, 0.01, False, None),
+    ("raw", "todayBatChgEnergy", 0x0695, 2, 0.01, False, None),
+    ("raw", "todayBatDisEnergy", 0x0699, 2, 0.01, False, None),
+    ("raw", "totalBatChgEnergy", 0x0697, 2, 0.1, False, None),
+    ("raw", "totalBatDisEnergy", 0x069B, 2, 0.1, False, None),
+)
+
+
+class Scheduler():
+    """Esegue job periodici a scadenze esatte (heap di scadenze, nessun polling a vuoto).
+
+    Ogni job è una funzione senza argomenti che gira nel pool e restituisce l'orario epoch
+    della prossima esecuzione, oppure None per non essere più ripianificato. Un job non
+    viene mai eseguito due volte in parallelo con se stesso, ma job diversi sì.
+    """
+
+    RETRY_DELAY = 60     # Secondi prima di riprovare un job terminato con eccezione
+    MAX_WAIT = 60        # Risveglio massimo: assorbe i salti dell'orologio (es. NTP al boot)
+
+    def __init__(self, executor, log):
+        self.executor = executor
+        self.log = log
+        self.heap = []
+        self.counter = itertools.count()
+        self.cond = threading.Condition()
+
+    def schedule(self, name, when, fn):
+        with self.cond:
+            heapq.heappush(self.heap, (when, next(self.counter), name, fn))
+            self.cond.notify()
+
+    def run_forever(self):
+        while True:
+            with self.cond:
+                while not self.heap or self.heap[0][0] > time.time():
+                    timeout = self.heap[0][0] - time.time() if self.heap else self.MAX_WAIT
+                    self.cond.wait(min(timeout, self.MAX_WAIT))
+                _, _, name, fn = heapq.heappop(self.heap)
+            self.executor.submit(self._run, name, fn)
+
+    def run_pending(self):
+        """Esegue nel thread chiamante i job già scaduti, compresi quelli che pianificano
+        per subito; restituisce quanti ne ha eseguiti. Usato da test e benchmark."""
+        eseguiti = 0
+        while True:
+            with self.cond:
+                if not self.heap or self.heap[0][0] > time.time():
+                    return eseguiti
+                _, _, name, fn = heapq.heappop(self.heap)
+            self._run(name, fn)
+            eseguiti += 1
+
+    def _run(self, name, fn):
+        try:
+            when = fn()
+        except Exception as e:
+            self.log(f"❌ Errore job {name}: {e}")
+            when = time.time() + self.RETRY_DELAY
+        if when is not None:
+            self.schedule(name, when, fn)
+
+
+class SampleStore():
+    """Archivio locale dei campioni live: un file binario append-only per inverter e per giorno.
+
+    Ogni file inizia con un'intestazione (magic, lunghezza, elenco JSON dei campi) seguita da
+    record a larghezza fissa: timestamp epoch (double) e un float32 per campo, NaN se assente.
+    I record sono in ordine di tempo, quindi le letture usano mmap e una ricerca binaria.
+    """
+
+    MAGIC = b"PMSAMP01"
+
+    def __init__(self, base_dir, fields):
+        self.base_dir = base_dir
+        self.fields = tuple(fields)
+        self.lock = threading.Lock()
+
+    def day_path(self, device_sn, giorno):
+        return os.path.join(self.base_dir, device_sn, f"{giorno.isoformat()}.bin")
+
+    def append(self, device_sn, ts, values):
+        """Aggiunge un campione; quelli non successivi all'ultimo già scritto vengono ignorati."""
+        path = self.day_path(device_sn, datetime.fromtimestamp(ts).date())
+        with self.lock:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fields = None
+            if os.path.exists(path):
+                fields, offset = self.read_header(path)
+                last = self.last_ts(path, offset, len(fields))
+                if last is not None and ts <= last:
+                    return False
+            with open(path, "ab") as f:
+                if fields is None:
+                    fields = self.fields
+                    header = json.dumps(fields).encode()
+                    f.write(self.MAGIC + struct.pack("<I", len(header)) + header)
+                row = [values.get(field) for field in fields]
+                row = [float(v) if isinstance(v, (int, float)) else math.nan for v in row]
+                f.write(struct.pack(f"<d{len(fields)}f", ts, *row))
+        return True
+
+    def last_ts(self, path, offset, nfields):
+        size = 8 + 4 * nfields
+        with open(path, "rb") as f:
+            end = f.seek(0, os.SEEK_END)
+            if end - offset < size:
+                return None
+            f.seek(offset + (end - offset) // size * size - size)
+            return struct.unpack("<d", f.read(8))[0]
+
+    def read_header(self, path):
+        with open(path, "rb") as f:
+            head = f.read(12)
+            if head[:8] != self.MAGIC:
+                raise ValueError(f"File campioni non valido: {path}")
+            size = struct.unpack("<I", head[8:])[0]
+            return tuple(json.loads(f.read(size))), 12 + size
+
+    def query(self, device_sn, start, end, fields=None):
+        """Restituisce (timestamp, {campo: valore}) per i campioni con start <= ts < end."""
+        giorno = datetime.fromtimestamp(start).date()
+        ultimo = datetime.fromtimestamp(end).date()
+        while giorno <= ultimo:
+            path = self.day_path(device_sn, giorno)
+            if os.path.exists(path) and os.path.getsize(path):
+                yield from self._query_file(path, start, end, fields)
+            giorno += timedelta(days=1)
+
+    def _query_file(self, path, start, end, fields):
+        names, rows = self._read_rows(path, start, end, fields)
+        for row in rows:
+            yield row[0], {name: v for name, v in zip(names, row[1:]) if not math.isnan(v)}
+
+    def _read_rows(self, path, start, end, fields):
+        # I campi non richiesti diventano byte di padding nel formato: struct li salta senza convertirli
+        file_fields, offset = self.read_header(path)
+        names = [f for f in file_fields if fields is None or f in fields]
+        layout = "".join("f" if fields is None or f in fields else "4x" for f in file_fields)
+        record = struct.Struct(f"<d{layout}")
+        with open(path, "rb") as f:
+            count = (os.fstat(f.fileno()).st_size - offset) // record.size
+            if count <= 0:
+                return names, ()
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                def ts_at(i):
+                    return struct.unpack_from("<d", mm, offset + i * record.size)[0]
+                first, last = self._bisect(ts_at, count, start), self._bisect(ts_at, count, end)
+                chunk = mm[offset + first * record.size:offset + last * record.size]
+        return names, record.iter_unpack(chunk)
+
+    def columns(self, device_sn, start, end, fields):
+        """Lettura a colonne: (lista timestamp, {campo: lista valori}), NaN dove il valore manca."""
+        timestamps, cols = [], {f: [] for f in fields}
+        giorno = datetime.fromtimestamp(start).date()
+        while giorno <= datetime.fromtimestamp(end).date():
+            path = self.day_path(device_sn, giorno)
+            if os.path.exists(path) and os.path.getsize(path):
+                names, rows = self._read_rows(path, start, end, fields)
+                rows = list(rows)
+                timestamps.extend(row[0] for row in rows)
+                for i, name in enumerate(names, 1):
+                    cols[name].extend(row[i] for row in rows)
+                for name in cols:
+                    if name not in names:
+                        cols[name].extend([math.nan] * len(rows))
+            giorno += timedelta(days=1)
+        return timestamps, cols
+
+    def _bisect(self, ts_at, count, target):
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if ts_at(mid) < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def downsample(self, device_sn, start, end, bucket, fields):
+        """Media dei campioni su intervalli di `bucket` secondi: [(inizio_intervallo, {campo: media})]."""
+        timestamps, cols = self.columns(device_sn, start, end, fields)
+        slots = {}
+        for name, col in cols.items():
+            for ts, v in zip(timestamps, col):
+                if math.isnan(v):
+                    continue
+                acc = slots.setdefault(start + (ts - start) // bucket * bucket, {}).setdefault(name, [0.0, 0])
+                acc[0] += v
+                acc[1] += 1
+        return [(slot, {name: acc[0] / acc[1] for name, acc in slots[slot].items()}) for slot in sorted(slots)]
+
+
+class HistoryIndex():
+    """Storico mensile in memoria: mesi ordinati e somme cumulative per pv/use/buy/sell.
+
+    Il file viene riletto solo quando cambia il suo mtime; i totali di un qualsiasi intervallo
+    di mesi si ottengono come differenza di due somme cumulative.
+    """
+
+    KEYS = ("pv", "use", "buy", "sell")
+
+    def __init__(self, path):
+        self.path = path
+        self.mtime = None
+        self.lock = threading.Lock()
+        self.build({})
+
+    def refresh(self, loader):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        with self.lock:
+            if mtime == self.mtime:
+                return
+        history = loader()
+        with self.lock:
+            self.build(history)
+            self.mtime = mtime
+
+    def build(self, history):
+        self.months = sorted((int(y), int(m)) for y in history for m in history[y])
+        self.data = [history[str(y)][str(m)] for y, m in self.months]
+        self.cum = {k: list(itertools.accumulate((d.get(k, 0.0) for d in self.data), initial=0.0)) for k in self.KEYS}
+
+    def set(self, history, path_mtime):
+        with self.lock:
+            self.build(history)
+            self.mtime = path_mtime
+
+    def total(self, first, last):
+        """Totali dei mesi compresi tra first e last inclusi (tuple (anno, mese)), None se vuoto."""
+        with self.lock:
+            i = bisect.bisect_left(self.months, first)
+            j = bisect.bisect_right(self.months, last)
+            if i >= j:
+                return None
+            return {k: round(self.cum[k][j] - self.cum[k][i], 2) for k in self.KEYS}
+
+    def rows(self):
+        with self.lock:
+            return list(zip(self.months, self.data))
+
+
+class ReleasePredictor():
+    """Stima quando il portale rilascerà il prossimo dato di un inverter.
+
+    Tiene una media mobile esponenziale dell'intervallo tra `updateDate` successivi e della
+    sua variabilità (jitter), più il ritardo con cui un dato diventa visibile dopo il suo
+    `updateDate`. Il ritardo viene misurato solo quando il dato è apparso dopo una sonda
+    a vuoto, cioè quando l'istante di comparsa è noto con precisione.
+    """
+
+    ALPHA = 0.2          # Peso delle nuove osservazioni nelle medie mobili
+    MIN_RETRY = 5        # Secondi minimi tra due sonde a vuoto
+    MAX_RETRY = 60       # Secondi massimi tra due sonde a vuoto
+
+    def __init__(self, interval=300, lag=15):
+        self.interval = float(interval)
+        self.jitter = 0.0
+        self.lag = float(lag)
+        self.last = None
+        self.stale_probes = 0
+
+    def observe(self, update_ts, seen_at):
+        if self.last is not None and update_ts > self.last:
+            gap = update_ts - self.last
+            gap /= max(1, round(gap / self.interval))   # Rilasci persi (notte, riavvii): si riporta a un periodo
+            err = gap - self.interval
+            self.interval += self.ALPHA * err
+            self.jitter += self.ALPHA * (abs(err) - self.jitter)
+        if self.stale_probes:
+            self.lag += self.ALPHA * ((seen_at - update_ts) - self.lag)
+        else:
+            self.lag *= 1 - self.ALPHA / 4   # Dato già pronto al primo colpo: si prova ad anticipare un po'
+        self.last = update_ts
+        self.stale_probes = 0
+
+    def next_poll(self, now):
+        if self.last is None:
+            return now + self.MIN_RETRY
+        return max(self.last + self.interval + self.lag + self.jitter, now + self.MIN_RETRY)
+
+    def retry_delay(self):
+        # Attese crescenti; dopo molte sonde a vuoto (portale fermo, notte) si arriva a un periodo intero
+        self.stale_probes += 1
+        limite = self.MAX_RETRY if self.stale_probes <= 10 else self.interval
+        return min(limite, max(self.MIN_RETRY, self.jitter) * self.stale_probes)
+
+
+class SessionExpired(Exception):
+    """Il portale ha risposto con la pagina di login o un errore di autenticazione."""
+
+
+class PortalUnavailable(Exception):
+    """Il circuit breaker è aperto: il portale viene considerato irraggiungibile."""
+
+
+class TokenBucket():
+    """Limita la frequenza delle richieste: `rate` gettoni al secondo, al massimo `burst` accumulati."""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                attesa = (1 - self.tokens) / self.rate
+            time.sleep(attesa)
+
+
+class CircuitBreaker():
+    """Interrompe le richieste al portale dopo troppi fallimenti consecutivi.
+
+    Aperto il circuito, le richieste falliscono subito senza traffico di rete fino alla
+    scadenza di un'attesa che raddoppia ad ogni nuova apertura (con jitter casuale). Alla
+    scadenza passa una sola richiesta di prova: se riesce il circuito si richiude. Il thread
+    che sta facendo la prova può proseguirla (es. nuovo login e secondo tentativo).
+    """
+
+    def __init__(self, threshold=5, base_delay=30, max_delay=1800, on_change=None):
+        self.threshold = threshold
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.on_change = on_change
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.trips = 0
+        self.open_until = 0.0
+        self.probing = None   # Thread che sta eseguendo la richiesta di prova
+
+    def is_open(self):
+        with self.lock:
+            return self.trips > 0 and (time.time() < self.open_until or self.probing is not None)
+
+    def check(self):
+        with self.lock:
+            if not self.trips or self.probing == threading.get_ident():
+                return
+            if time.time() < self.open_until or self.probing is not None:
+                raise PortalUnavailable(f"portale sospeso per altri {max(0, self.open_until - time.time()):.0f}s")
+            self.probing = threading.get_ident()   # Half-open: passa solo questa richiesta di prova
+
+    def success(self):
+        with self.lock:
+            era_aperto = self.trips > 0
+            self.failures = self.trips = 0
+            self.probing = None
+        if era_aperto and self.on_change:
+            self.on_change(True)
+
+    def failure(self):
+        with self.lock:
+            if self.trips and self.probing != threading.get_ident():
+                # Circuito già aperto: è una richiesta partita prima dell'apertura, non una nuova prova fallita
+                return
+            self.failures += 1
+            if self.probing is None and self.failures < self.threshold:
+                return
+            self.probing = None
+            self.failures = 0
+            self.trips += 1
+            delay = min(self.max_delay, self.base_delay * 2 ** (self.trips - 1))
+            self.open_until = time.time() + delay * random.uniform(0.5, 1.5)
+            primo = self.trips == 1
+        if primo and self.on_change:
+            self.on_change(False)
+
+
+class Metrics():
+    """Contatori, valori istantanei e istogrammi di latenza del bridge.
+
+    Le serie sono identificate da nome ed etichette (es. endpoint, seriale) e possono essere
+    esportate in formato testo Prometheus o lette come valori singoli per i sensori HA.
+    """
+
+    BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)   # Secondi
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.windows = {}       # chiave -> (somma, conteggio, media) all'ultima lettura di interval_mean
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            h = self.histograms.setdefault(key, {"buckets": [0] * len(self.BUCKETS), "sum": 0.0, "count": 0})
+            for i, limite in enumerate(self.BUCKETS):
+                if seconds <= limite:
+                    h["buckets"][i] += 1
+            h["sum"] += seconds
+            h["count"] += 1
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def counter(self, name, **labels):
+        with self.lock:
+            return self.counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def gauge(self, name, **labels):
+        with self.lock:
+            return self.gauges.get((name, tuple(sorted(labels.items()))))
+
+    def mean(self, name, **labels):
+        with self.lock:
+            h = self.histograms.get((name, tuple(sorted(labels.items()))))
+            return h["sum"] / h["count"] if h and h["count"] else None
+
+    def interval_mean(self, name, **labels):
+        """Media delle osservazioni arrivate dalla lettura precedente.
+
+        A differenza di mean() non è cumulativa dall'avvio: se nell'intervallo non ci sono
+        nuove osservazioni restituisce l'ultima media calcolata.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            h = self.histograms.get(key)
+            if not h:
+                return None
+            somma, conteggio, media = self.windows.get(key, (0.0, 0, None))
+            if h["count"] > conteggio:
+                media = (h["sum"] - somma) / (h["count"] - conteggio)
+            self.windows[key] = (h["sum"], h["count"], media)
+            return media
+
+    def prometheus(self):
+        def fmt(labels, extra=()):
+            items = list(labels) + list(extra)
+            return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}" if items else ""
+        lines = []
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append(f"{name}_total{fmt(labels)} {value}")
+            for (name, labels), value in sorted(self.gauges.items()):
+                lines.append(f"{name}{fmt(labels)} {value}")
+            for (name, labels), h in sorted(self.histograms.items()):
+                for limite, n in zip(self.BUCKETS, h["buckets"]):
+                    lines.append(f"{name}_bucket{fmt(labels, [('le', limite)])} {n}")
+                lines.append(f"{name}_bucket{fmt(labels, [('le', '+Inf')])} {h['count']}")
+                lines.append(f"{name}_sum{fmt(labels)} {h['sum']:.6f}")
+                lines.append(f"{name}_count{fmt(labels)} {h['count']}")
+        return "\n".join(lines) + "\n"
+
+
+class MqttOutbox():
+    """Coda su disco dei messaggi MQTT non consegnabili (broker irraggiungibile).
+
+    I messaggi retained sullo stesso topic si fondono: resta solo l'ultimo valore. La coda
+    ha una dimensione massima (i messaggi più vecchi vengono scartati) ed è salvata come
+    journal JSON-lines, compattato quando cresce troppo o quando la coda viene svuotata.
+    """
+
+    def __init__(self, path, max_items):
+        self.path = path
+        self.max_items = max_items
+        self.lock = threading.Lock()
+        self.items = collections.OrderedDict()   # ("r", topic) | ("n", seq) -> (topic, payload, retain)
+        self.seq = itertools.count()
+        self.dropped = 0
+        self.journal_lines = 0
+        self.load()
+
+    def __len__(self):
+        with self.lock:
+            return len(self.items)
+
+    def _add(self, topic, payload, retain):
+        key = ("r", topic) if retain else ("n", next(self.seq))
+        self.items.pop(key, None)
+        self.items[key] = (topic, payload, retain)
+        while len(self.items) > self.max_items:
+            self.items.popitem(last=False)
+            self.dropped += 1
+
+    def load(self):
+        try:
+            with open(self.path, "r") as f:
+                for line in f:
+                    try:
+                        m = json.loads(line)
+                        self._add(m["t"], m["p"], m["r"])
+                    except (json.JSONDecodeError, KeyError):
+                        continue   # Riga troncata da uno spegnimento improvviso
+        except FileNotFoundError:
+            return
+        self._compact()
+
+    def put(self, topic, payload, retain):
+        with self.lock:
+            self._add(topic, payload, retain)
+            with open(self.path, "a") as f:
+                f.write(json.dumps({"t": topic, "p": payload, "r": retain}) + "\n")
+            self.journal_lines += 1
+            if self.journal_lines > 2 * self.max_items:
+                self._compact()
+
+    def peek(self, count):
+        with self.lock:
+            return list(itertools.islice(self.items.items(), count))
+
+    def ack(self, keys):
+        # Rimuove i messaggi consegnati (se nel frattempo un retained è stato aggiornato, resta in coda)
+        with self.lock:
+            for key, item in keys:
+                if self.items.get(key) is item:
+                    del self.items[key]
+            self._compact()
+
+    def _compact(self):
+        if not self.items:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self.path)
+            self.journal_lines = 0
+            return
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            for topic, payload, retain in self.items.values():
+                f.write(json.dumps({"t": topic, "p": payload, "r": retain}) + "\n")
+        os.replace(tmp_path, self.path)
+        self.journal_lines = len(self.items)
+
+
+class WindowAggregator():
+    """Statistiche di un sensore su finestre fisse allineate all'orologio (es. 5 min, 1 h).
+
+    Memoria costante: per la finestra in corso si tengono solo min, max, somma, area e
+    l'ultimo campione. L'energia è l'integrale con la regola dei trapezi; il tratto che
+    attraversa il confine tra due finestre viene diviso per interpolazione lineare. Buchi
+    più lunghi di MAX_GAP secondi non vengono integrati.
+    """
+
+    MAX_GAP = 900
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.last = None   # (ts, valore) dell'ultimo campione
+        self.reset(None)
+
+    def reset(self, start):
+        self.start = start
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self.area = 0.0      # Watt * secondi
+        self.covered = 0.0   # Secondi integrati
+
+    def integrate(self, t0, v0, t1, v1):
+        self.area += (v0 + v1) / 2 * (t1 - t0)
+        self.covered += t1 - t0
+
+    def result(self):
+        mean = self.area / self.covered if self.covered else self.total / self.count
+        return {"min": round(self.min, 2), "max": round(self.max, 2), "mean": round(mean, 2),
+                "energy": round(self.area / 3600, 2), "samples": self.count,
+                "start": int(self.start), "end": int(self.start + self.seconds)}
+
+    def add(self, ts, value):
+        """Aggiunge un campione; restituisce le statistiche della finestra appena chiusa, se ce n'è una."""
+        if self.last is not None and ts <= self.last[0]:
+            return None
+        start = ts - ts % self.seconds
+        completed = None
+        contiguous = self.last is not None and ts - self.last[0] <= self.MAX_GAP
+        if self.start is None:
+            self.reset(start)
+        elif start > self.start:
+            boundary = self.start + self.seconds
+            t0, v0 = self.last
+            vb = v0 + (value - v0) * (boundary - t0) / (ts - t0)
+            if contiguous:
+                self.integrate(t0, v0, boundary, vb)
+            completed = self.result() if self.count else None
+            self.reset(start)
+            if contiguous and start == boundary:
+                self.integrate(boundary, vb, ts, value)
+            contiguous = False
+        if contiguous:
+            self.integrate(*self.last, ts, value)
+        self.count += 1
+        self.total += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        self.last = (ts, value)
+        return completed
+
+
+class DataSource(abc.ABC):
+    """Sorgente locale, alternativa al portale, per i dati istantanei di un inverter.
+
+    read() restituisce la coppia (live, raw) con gli stessi campi dei dizionari del portale,
+    così la pubblicazione resta unica qualunque sia la sorgente; in caso di errore solleva
+    un'eccezione e il bridge torna al polling cloud. Le sottoclassi si registrano in
+    DATA_SOURCES con il proprio `name`.
+    """
+
+    name = None
+
+    @classmethod
+    @abc.abstractmethod
+    def from_options(cls, options, registers):
+        """Costruisce la sorgente dalle opzioni dell'impianto."""
+
+    @abc.abstractmethod
+    def read(self):
+        """Legge i dati correnti: (live, raw)."""
+
+    def close(self):
+        pass
+
+
+class ModbusSource(DataSource):
+    """Lettura diretta del data-logger via Modbus TCP (solo libreria standard).
+
+    I registri vengono raggruppati in blocchi contigui una volta sola, all'avvio: ogni
+    lettura costa poche richieste sulla LAN invece dei quattro giri verso il portale.
+    """
+
+    name = "modbus"
+    MAX_BLOCK = 100   # Registri per richiesta (il protocollo ne ammette 125)
+    MAX_GAP = 8       # Registri inutilizzati tollerati pur di unire due blocchi
+
+    def __init__(self, host, port=502, unit=1, registers=MODBUS_REGISTERS, function=3, timeout=3):
+        self.host = host
+        self.port = port
+        self.unit = unit
+        self.function = function
+        self.timeout = timeout
+        self.registers = [tuple(r) for r in registers]
+        self.blocks = self.plan_blocks(self.registers)
+        self.sock = None
+        self.tid = itertools.count(1)
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_options(cls, options, registers=MODBUS_REGISTERS):
+        return cls(options["modbus_host"], int(options.get("modbus_port") or 502),
+                   int(options.get("modbus_unit") or 1), registers)
+
+    def plan_blocks(self, registers):
+        # [(primo registro, quanti registri)] che coprono tutta la mappa
+        blocks = []
+        for _, _, address, words, *_ in sorted(registers, key=lambda r: r[2]):
+            end = address + words
+            if blocks and address - (blocks[-1][0] + blocks[-1][1]) <= self.MAX_GAP and end - blocks[-1][0] <= self.MAX_BLOCK:
+                blocks[-1][1] = max(blocks[-1][1], end - blocks[-1][0])
+            else:
+                blocks.append([address, words])
+        return [tuple(b) for b in blocks]
+
+    def connect(self):
+        if self.sock is None:
+            self.sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        return self.sock
+
+    def close(self):
+        if self.sock is not None:
+            with contextlib.suppress(OSError):
+                self.sock.close()
+            self.sock = None
+
+    def recv_exact(self, size):
+        data = b""
+        while len(data) < size:
+            chunk = self.sock.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError("connessione Modbus chiusa dal logger")
+            data += chunk
+        return data
+
+    def read_block(self, address, count):
+        tid = next(self.tid) & 0xFFFF
+        self.connect().sendall(struct.pack(">HHHBBHH", tid, 0, 6, self.unit, self.function, address, count))
+        rtid, _, length, _ = struct.unpack(">HHHB", self.recv_exact(7))
+        pdu = self.recv_exact(length - 1)
+        if rtid != tid:
+            raise ConnectionError(f"risposta Modbus fuori sequenza ({rtid} invece di {tid})")
+        if pdu[0] & 0x80:
+            raise ConnectionError(f"eccezione Modbus {pdu[1]} leggendo {address:#06x}")
+        return struct.unpack(f">{pdu[1] // 2}H", pdu[2:2 + pdu[1]])
+
+    def read(self):
+        with self.lock:
+            try:
+                words = {}
+                for address, count in self.blocks:
+                    words.update(zip(range(address, address + count), self.read_block(address, count)))
+            except (OSError, struct.error):
+                self.close()   # Alla prossima lettura si riapre la connessione
+                raise
+        dati = {"live": {"updateDate": int(time.time() * 1000)}, "raw": {}}
+        for source, field, address, size, scale, signed, direction in self.registers:
+            value = words[address] if size == 1 else words[address] << 16 | words[address + 1]
+            if signed and value >= 1 << (16 * size - 1):
+                value -= 1 << (16 * size)
+            value = round(value * scale, 3)
+            if direction:
+                dati["live"][direction] = (value > 0) - (value < 0)
+                value = abs(value)
+            dati[source][field] = value
+        return dati["live"], dati["raw"]
+
+
+# Sorgenti locali selezionabili per inverter con l'opzione `source` (il default è il portale cloud)
+DATA_SOURCES = {"modbus": ModbusSource}
+
+
+class PeimarDevice():
+    """Un inverter monitorato: identificativi sul portale, ultimi dati scaricati e topic dedicati."""
+
+    def __init__(self, plant_uid, device_sn, name, history_path, topic):
+        self.PLANT_UID = plant_uid
+        self.DAILY_DIR = None
+        self.DEVICE_SN = device_sn
+        self.NAME = name
+        self.HISTORY_PATH = history_path
+        self.history = HistoryIndex(history_path)
+        self.TOPIC = topic
+        self.plant = {}
+        self.live = {}
+        self.raw = {}
+        self.bean = {}
+        self.last_processed_ts = 0   # Per ricordare l'ultima lettura utile (orario del portale)
+        self.portal_ts = 0   # updateDate dell'ultima risposta del portale, indipendente dalla sorgente locale
+        self.release = ReleasePredictor()
+        self.fetched = {}   # endpoint -> (orario scaricamento, giorno) per la cache TTL
+        self.RAW_CHECKPOINT_PATH = None
+        self.published = {}   # topic -> (ultimo valore pubblicato, orario)
+        self.SNAPSHOT_PATH = None
+        self.local = None   # DataSource locale, se configurata; il portale resta la riserva
+        self.local_failures = 0
+        self.snapshot_saved = 0
+        self.aggregators = {}   # (topic, minuti) -> WindowAggregator
+        self.history_started = False   # Lo storico si scarica solo dopo il primo ciclo di polling
+
 
 class PeimarTester():
     def __init__(self):
         # Percorsi Home Assistant Add-on
-        self.OPTIONS_PATH = "/data/options.json"
-        self.HISTORY_PATH = "/share/peimar_history.json"
+        # (sovrascrivibili da ambiente per eseguire il bridge fuori dal container, es. nel benchmark)
+        self.DATA_DIR = os.environ.get("PEIMAR_DATA_DIR", "/data")
+        self.SHARE_DIR = os.environ.get("PEIMAR_SHARE_DIR", "/share")
+        self.OPTIONS_PATH = f"{self.DATA_DIR}/options.json"
+        self.HISTORY_PATH = f"{self.SHARE_DIR}/peimar_history.json"
+        self.DISCOVERY_CACHE_PATH = f"{self.DATA_DIR}/peimar_discovery.json"
+        self.OUTBOX_PATH = f"{self.DATA_DIR}/peimar_outbox.jsonl"
+        self.SAMPLES_DIR = f"{self.SHARE_DIR}/peimar_samples"
         
         # Carica configurazione dall'interfaccia Add-on
         try:
@@ -21,11 +996,11 @@ class PeimarTester():
             conf = {}
         
         # ====== CONFIGURAZIONE PEIMAR (Dalle opzioni Add-on) ======
-        self.BASE = "http://www.peimar-portal.com"
+        self.BASE = os.environ.get("PEIMAR_PORTAL_URL", "http://www.peimar-portal.com")
         self.USERNAME = conf.get("peimar_user", "")
         self.PASSWORD = conf.get("peimar_pass", "")
-        self.PLANT_UID = "5F7C9010-3FE6-40A1-8E59-975D45ED6BC2"
-        self.DEVICE_SN = "H1S2602J2050E00358"
+        self.MAX_INFLIGHT = int(conf.get("max_concurrent_requests", 4))  # Richieste HTTP contemporanee verso il portale
+        self.POLL_STAGGER = int(conf.get("poll_stagger", 15))  # Secondi di sfasamento tra i polling di inverter diversi
 
         # ====== CONFIGURAZIONE MQTT ======
         self.MQTT_HOST = conf.get("mqtt_host", "core-mosquitto") 
@@ -33,8 +1008,101 @@ class PeimarTester():
         self.MQTT_USER = conf.get("mqtt_user", "mqtt")
         self.MQTT_PASS = conf.get("mqtt_pass", "mqttpassword")
         self.MQTT_PREFIX = "peimar"
+        self.OUTBOX_SIZE = int(conf.get("outbox_size", 5000))  # Messaggi trattenuti a broker scollegato (0 = nessuna coda)
+        self.OUTBOX_BATCH = 50  # Messaggi inviati per lotto allo svuotamento della coda
+        self.OUTBOX_BATCH_DELAY = 0.2  # Pausa tra due lotti, per non inondare il broker alla riconnessione
+        self.PUBLISH_MODE = conf.get("publish_mode", "topics")  # "topics": un topic per sensore, "json": un unico topic di stato
+        self.PUBLISH_DEADBAND = float(conf.get("publish_deadband", 0))  # Variazione % minima per ripubblicare un float
+        self.PUBLISH_MAX_AGE = int(conf.get("publish_max_age", 3600))  # Secondi dopo cui un valore invariato viene ripubblicato
+        # Statistiche (min/max/media/energia) dei sensori di potenza su finestre di N minuti, pubblicate come
+        # sensori separati: i topic grezzi possono così essere esclusi dal recorder di Home Assistant
+        self.AGGREGATE_WINDOWS = sorted({int(m) for m in conf.get("aggregate_windows") or []})
+        self.AGGREGATE_SENSORS = [s for s in SENSORS if s.dev_class == "power"]
+
+        # ====== ARCHIVIO CAMPIONI ======
+        self.sample_store = SampleStore(self.SAMPLES_DIR, SAMPLE_FIELDS) if conf.get("sample_store", True) else None
+
+        # ====== INGESTIONE RECORD RAW ======
+        # Con raw_ingest i campioni nell'archivio arrivano dai record raw completi e non dal solo ultimo valore
+        self.RAW_INGEST = bool(conf.get("raw_ingest", False))
+        self.RAW_BATCH_MQTT = bool(conf.get("raw_batch_mqtt", False))  # Pubblica i record anche su <sn>/raw/batch
+        self.RAW_INGEST_INTERVAL = 900  # Secondi tra due ingestioni
+        self.RAW_BACKFILL_DAYS = 7  # Giorni massimi recuperati dopo un'interruzione
+        self.RAW_PAGE_SIZE = 100
+        self.RAW_BATCH_SIZE = 50  # Record per messaggio MQTT e tra due checkpoint
+
+        # ====== IMPIANTI / INVERTER ======
+        # Il primo inverter mantiene il file storico originale, gli altri ne hanno uno dedicato
+        plants = conf.get("plants") or [{"plant_uid": "5F7C9010-3FE6-40A1-8E59-975D45ED6BC2",
+                                         "device_sn": "H1S2602J2050E00358"}]
+        self.MODBUS_MAP_PATH = f"{self.SHARE_DIR}/peimar_modbus_map.json"  # Mappa registri alternativa (lista JSON)
+        self.devices = []
+        for i, p in enumerate(plants):
+            sn = p["device_sn"]
+            history_path = self.HISTORY_PATH if i == 0 else f"{self.SHARE_DIR}/peimar_history_{sn}.json"
+            dev = PeimarDevice(p["plant_uid"], sn, p.get("name") or "Inverter Peimar",
+                               history_path, f"{self.MQTT_PREFIX}/{sn}")
+            dev.RAW_CHECKPOINT_PATH = f"{self.DATA_DIR}/peimar_raw_{sn}.json"
+            dev.DAILY_DIR = f"{self.SHARE_DIR}/peimar_daily_{sn}"
+            dev.SNAPSHOT_PATH = f"{self.DATA_DIR}/peimar_snapshot_{sn}.json"
+            dev.aggregators = {(s.topic, m): WindowAggregator(m * 60) for s in self.AGGREGATE_SENSORS
+                               for m in self.AGGREGATE_WINDOWS}
+            if p.get("source", "cloud") != "cloud":
+                dev.local = DATA_SOURCES[p["source"]].from_options(p, self.load_modbus_map())
+            self.devices.append(dev)
+
+        # ====== SORGENTE LOCALE ======
+        self.LOCAL_INTERVAL = int(conf.get("local_interval", 10))  # Secondi tra due letture in LAN
+        self.LOCAL_MAX_FAILURES = 3  # Letture locali fallite di fila prima di tornare al portale
+        self.SNAPSHOT_INTERVAL = 60  # Salvataggio dell'ultimo stato al massimo ogni N secondi con la lettura locale
+
+        # ====== STORICO ======
+        self.HISTORY_GRACE_DAYS = 2  # Giorni dopo il cambio mese in cui il mese precedente viene ancora riscaricato
+        self.HISTORY_SYNC_TIME = "00:05"  # Orario della sincronizzazione notturna dello storico
+        self.HISTORY_REQUEST_DELAY = 0.5  # Pausa tra due mesi scaricati, per non martellare il portale
+        # Con history_daily lo storico si scarica giorno per giorno (un file per mese in /share) e i totali
+        # mensili si calcolano in locale; il primo recupero è lungo ma riprende da dove si era interrotto
+        self.HISTORY_DAILY = bool(conf.get("history_daily", False))
+        self.BACKFILL_WORKERS = 3  # Giorni scaricati in parallelo
+        self.BACKFILL_RATE = 2  # Richieste al secondo al massimo durante il recupero giornaliero
+        self.SNAPSHOT_MAX_AGE = 3600  # Età massima (secondi) dell'ultimo stato salvato ripubblicato all'avvio
+
+        # ====== SCHEDULER ======
+        self.LOGIN_INTERVAL = 6 * 3600  # Secondi tra due login programmati
+        self.DISCOVERY_REFRESH = 24 * 3600  # Secondi tra due annunci discovery
+        self.JOB_WORKERS = 3 * len(self.devices) + 4  # Job contemporanei: polling cloud, locale e ingestione raw per inverter + login, storico, discovery, diagnostica
+
+        # ====== HTTP ======
+        self.HTTP_WORKERS = max(4, self.MAX_INFLIGHT)  # Almeno un worker per ciascun endpoint di fetch_data()
+        self.HTTP_TIMEOUTS = {"plant": 15, "live": 15, "raw": 20, "bean": 30}  # Secondi per endpoint
+        # TTL (secondi) della cache per endpoint: 0 = sempre riscaricato. live e raw portano i valori istantanei.
+        self.CACHE_TTL = {"plant": 3600, "live": 0, "raw": 0, "bean": 900}
+        self.CACHE_TTL.update({k: int(v) for k, v in (conf.get("cache_ttl") or {}).items()})
+        # Endpoint letti da process_and_publish: gli altri vengono saltati a meno di fetch_unused_endpoints
+        self.USED_ENDPOINTS = set(PUBLISH_SOURCES)
+        if conf.get("fetch_unused_endpoints", False):
+            self.USED_ENDPOINTS |= {"plant", "bean"}
+
+        # ====== SESSIONE / DISPONIBILITÀ ======
+        self.AUTH_ERROR_CODES = {"401", "403", "-401", "1001"}  # Codici JSON del portale per sessione non valida
+        self.AVAILABILITY_TOPIC = f"{self.MQTT_PREFIX}/bridge/availability"  # Bridge in linea (LWT); i dati di ogni inverter hanno <sn>/availability
+        self.BREAKER_THRESHOLD = 5  # Fallimenti consecutivi prima di sospendere le richieste
+        self.BREAKER_DELAY = 30  # Prima sospensione (secondi), raddoppia ad ogni apertura successiva
+        self.BREAKER_MAX_DELAY = 1800
+
+        # ====== DIAGNOSTICA ======
+        self.DIAGNOSTICS_TOPIC = f"{self.MQTT_PREFIX}/bridge/diagnostics"
+        self.DIAGNOSTICS_INTERVAL = 60  # Secondi tra due pubblicazioni dei sensori diagnostici
+        self.PROMETHEUS = bool(conf.get("prometheus", False))  # Endpoint /metrics in formato Prometheus
+        self.PROMETHEUS_PORT = 9105
 
         # ====== STATO INTERNO ======
+        self.metrics = Metrics()
+        self.breaker = CircuitBreaker(self.BREAKER_THRESHOLD, self.BREAKER_DELAY, self.BREAKER_MAX_DELAY,
+                                      on_change=self.set_availability)
+        self.login_lock = threading.RLock()
+        self.login_generation = 0
+        self.relogin_state = threading.local()   # Durante un re-login l'esito non conta ancora per il breaker
         self.session = requests.Session()
         self.session.headers.update({
             "User-Agent": "Mozilla/5.0",
@@ -43,16 +1111,30 @@ class PeimarTester():
             "X-Requested-With": "XMLHttpRequest",
             "Referer": f"{self.BASE}/portal/login"
         })
-        self.plant = {}
-        self.live = {}
-        self.raw = {}
-        self.bean = {}
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.MAX_INFLIGHT)
+        self.http_slots = threading.BoundedSemaphore(self.MAX_INFLIGHT)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.executor = ThreadPoolExecutor(max_workers=self.HTTP_WORKERS, thread_name_prefix="peimar-http")
         self.last_login = datetime.now() - timedelta(hours=7)
+        self.scheduler = Scheduler(ThreadPoolExecutor(max_workers=self.JOB_WORKERS, thread_name_prefix="peimar-job"), self.log)
         
         # Setup MQTT (Callback V2)
         self.mqttc = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
         self.mqttc.username_pw_set(self.MQTT_USER, self.MQTT_PASS)
         self.mqttc.on_message = self.on_message
+        self.mqttc.on_connect = self.on_connect
+        self.mqttc.will_set(self.AVAILABILITY_TOPIC, "offline", retain=True)
+        self.outbox = MqttOutbox(self.OUTBOX_PATH, self.OUTBOX_SIZE) if self.OUTBOX_SIZE else None
+        if self.outbox and len(self.outbox):
+            self.log(f"📬 {len(self.outbox)} messaggi MQTT in coda dall'esecuzione precedente")
+        self.discovery_payloads = {}
+        self.discovery_lock = threading.Lock()
+        self.discovery_pending = False   # Annunci persi a broker scollegato, da ripetere in on_connect
+        # I payload discovery degli inverter dipendono solo dalla configurazione: si costruiscono una volta
+        self.device_discovery = {}
+        for dev in self.devices:
+            self.announce_device(dev)
         
         try:
             self.mqttc.connect_async(self.MQTT_HOST, self.MQTT_PORT)
@@ -65,238 +1147,823 @@ class PeimarTester():
         print(f"[{datetime.now().strftime('%H:%M:%S')}] {msg}", flush=True)
 
     def clean_value(self, value):
-        if value is None: return 0.0
-        try:
-            if isinstance(value, str):
-                clean_str = value.replace('%', '').replace('kWh', '').replace('W', '').replace(',', '.').strip()
-                return float(clean_str)
-            return float(value)
-        except: return 0.0
-        
-    def announce_sensor(self, name, topic, unit="", dev_class=None, state_class="measurement"):
-        discovery_topic = f"homeassistant/sensor/{self.MQTT_PREFIX}/{topic.replace('/', '_')}/config"
+        return to_float(value)
+
+    def announce_sensor(self, dev, sensor):
+        name, topic, unit, dev_class, state_class = sensor.name, sensor.topic, sensor.unit, sensor.dev_class, sensor.state_class
+        discovery_topic = f"homeassistant/sensor/{self.MQTT_PREFIX}/{dev.DEVICE_SN}_{topic.replace('/', '_')}/config"
         payload = {
             "name": f"{name}",
-            "state_topic": f"{self.MQTT_PREFIX}/{topic}",
-            "unique_id": f"peimar_{self.DEVICE_SN}_{topic.replace('/', '_')}",
+            "state_topic": f"{dev.TOPIC}/{topic}",
+            "unique_id": f"peimar_{dev.DEVICE_SN}_{topic.replace('/', '_')}",
             "unit_of_measurement": unit,
+            **self.device_availability(dev),
             "device": {
-                "identifiers": [f"peimar_inverter_{self.DEVICE_SN}"],
-                "name": "Inverter Peimar",
+                "identifiers": [f"peimar_inverter_{dev.DEVICE_SN}"],
+                "name": dev.NAME,
                 "manufacturer": "Peimar"
             }
         }
+        if self.PUBLISH_MODE == "json":
+            payload["state_topic"] = f"{dev.TOPIC}/state"
+            payload["value_template"] = f"{{{{ value_json.{topic.replace('/', '_')} }}}}"
         if dev_class: payload["device_class"] = dev_class
         if state_class: payload["state_class"] = state_class
-        self.mqttc.publish(discovery_topic, json.dumps(payload), retain=True)
-        
-    def setup_discovery(self):
-        self.log("📣 Annuncio sensori a Home Assistant...")
-        # ================== FOTOVOLTAICO =============================
-        self.announce_sensor("Potenza Impianto", "pv/solar_power", "KW")
-        self.announce_sensor("Potenza PV Live", "pv/power_now", "W", "power", "measurement")
-        self.announce_sensor("Potenza S1 Live", "pv/pv1_power", "W", "power", "measurement")
-        self.announce_sensor("Potenza S2 Live", "pv/pv2_power", "W", "power", "measurement")
-        self.announce_sensor("Tensione S1 Live", "pv/pv1_volt", "V", "voltage", "measurement")
-        self.announce_sensor("Tensione S2 Live", "pv/pv2_volt", "V", "voltage", "measurement")
-        self.announce_sensor("Corrente S1 Live", "pv/pv1_current", "A", "current", "measurement")
-        self.announce_sensor("Corrente S2 Live", "pv/pv2_current", "A", "current", "measurement")
-        self.announce_sensor("Energia Prodotta Oggi", "pv/energy_today", "kWh", "energy", "total_increasing")
-        # --- DETTAGLI BATTERIA ---
-        self.announce_sensor("Capacità Batteria", "battery/capacity", "Ah")
-        self.announce_sensor("SOC Batteria", "battery/soc", "%", "battery", "measurement")
-        self.announce_sensor("Potenza Batteria Live", "battery/power_live", "W", "power", "measurement")
-        self.announce_sensor("Tensione Batteria", "battery/volt", "V", "voltage", "measurement")
-        self.announce_sensor("Corrente Batteria", "battery/current", "A", "current", "measurement")
-        self.announce_sensor("Energia Caricata in Bat. Oggi", "battery/today_charge_energy", "kWh", "energy", "total_increasing")
-        self.announce_sensor("Energia Scaricata da Bat. Oggi", "battery/today_discharge_energy", "kWh", "energy", "total_increasing")
-        self.announce_sensor("Stato Batteria", "battery/battery_status", "", None, None)
-        # ======= DETTAGLI CARICO CASA / RETE ===============================================================
-        self.announce_sensor("Consumo Casa Live", "house/load_live", "W", "power", "measurement")
-        self.announce_sensor("Consumo Casa oggi", "house/energy_consumption_today", "kWh", "energy", "total_increasing")
-        self.announce_sensor("Energia Importata Oggi", "house/import_today", "kWh", "energy", "total_increasing")
-        self.announce_sensor("Energia Esportata Oggi", "house/export_today", "kWh", "energy", "total_increasing")
-        self.announce_sensor("Potenza Rete Live", "grid/power", "W", "power", "measurement")
-        self.announce_sensor("Tensione Rete Live", "grid/grid_voltage", "V", "voltage", "measurement")
-        self.announce_sensor("Corrente Rete Live", "grid/grid_current", "A", "current", "measurement")
-        self.announce_sensor("Frequenza Rete Live", "grid/grid_frequency", "Hz", "frequency", "measurement")
-        self.announce_sensor("Stato Rete", "grid/grid_status", "", None, None)
-        # ========== INVERTER ===================================
-        self.announce_sensor("Temperatura Inverter", "inverter/deviceTemp", "°C", "temperature", "measurement")
-        # ==================== STATUS =========================================================
-        self.announce_sensor("Ultimo Aggiornamento", "status/last_update_time", "", None, None)
+        self.device_discovery[discovery_topic] = json.dumps(payload, sort_keys=True)
 
-    def login(self):
+    def setup_discovery(self, force=False):
+        # Gli hash dei payload già pubblicati sono salvati in /data: al riavvio si pubblicano
+        # solo i sensori nuovi o modificati e si rimuovono quelli non più esistenti.
+        with self.discovery_lock:
+            self.discovery_payloads = dict(self.device_discovery)
+            self.announce_diagnostics()
+
+            cache = self.load_discovery_cache()
+            if cache is None:
+                # Primo avvio con la cache: svuota anche i topic discovery senza seriale delle versioni
+                # precedenti, prima di annunciare i nuovi, altrimenti HA scarta gli unique_id duplicati
+                cache = {f"homeassistant/sensor/{self.MQTT_PREFIX}/{topic}/config": "" for topic in LEGACY_DISCOVERY}
+
+            nuovi = {topic: hashlib.sha1(payload.encode()).hexdigest() for topic, payload in self.discovery_payloads.items()}
+            rimossi = [topic for topic in cache if topic not in nuovi]
+            modificati = [topic for topic in nuovi if force or cache.get(topic) != nuovi[topic]]
+
+            # Nella cache finisce solo ciò che è stato davvero pubblicato: un annuncio perso (broker non
+            # ancora collegato e nessuna coda) resta con il vecchio hash e viene ripetuto alla connessione
+            salvati = dict(nuovi)
+            persi = 0
+            for topic in rimossi:
+                if not self.publish(topic, "", retain=True):
+                    salvati[topic] = cache[topic]
+                    persi += 1
+            for topic in modificati:
+                if not self.publish(topic, self.discovery_payloads[topic], retain=True):
+                    salvati.pop(topic)
+                    if topic in cache:
+                        salvati[topic] = cache[topic]
+                    persi += 1
+            self.save_discovery_cache(salvati)
+            self.discovery_pending = persi > 0
+            if persi:
+                self.log(f"⚠️ Discovery: {persi} annunci non pubblicati (broker MQTT non collegato), ripetuti alla connessione")
+            self.log(f"📣 Discovery: {len(modificati)} sensori annunciati, {len(rimossi)} rimossi, "
+                     f"{len(nuovi) - len(modificati)} invariati")
+
+    def announce_diagnostic(self, key, name, unit="", dev_class=None, state_class="measurement"):
+        payload = {
+            "name": name,
+            "state_topic": self.DIAGNOSTICS_TOPIC,
+            "value_template": f"{{{{ value_json['{key}'] }}}}",
+            "unique_id": f"peimar_bridge_{key}",
+            "unit_of_measurement": unit,
+            "entity_category": "diagnostic",
+            "state_class": state_class,
+            "device": {
+                "identifiers": ["peimar_bridge"],
+                "name": "Peimar Bridge",
+                "manufacturer": "Peimar"
+            }
+        }
+        if dev_class: payload["device_class"] = dev_class
+        self.discovery_payloads[f"homeassistant/sensor/{self.MQTT_PREFIX}/bridge_{key}/config"] = json.dumps(payload, sort_keys=True)
+
+    def announce_diagnostics(self):
+        for endpoint in PORTAL_ENDPOINTS:
+            self.announce_diagnostic(f"http_{endpoint}_ms", f"Latenza {endpoint}", "ms", "duration")
+            self.announce_diagnostic(f"http_{endpoint}_errors", f"Errori {endpoint}", state_class="total_increasing")
+        self.announce_diagnostic("mqtt_published", "Messaggi MQTT pubblicati", state_class="total_increasing")
+        self.announce_diagnostic("outbox_depth", "Messaggi MQTT in coda")
+        self.announce_diagnostic("outbox_flush_ms", "Durata svuotamento coda MQTT", "ms", "duration")
+        for dev in self.devices:
+            sn = dev.DEVICE_SN
+            self.announce_diagnostic(f"{sn}_data_age", f"Età dati {dev.NAME} ({sn})", "s", "duration")
+            self.announce_diagnostic(f"{sn}_poll_to_publish", f"Latenza polling-pubblicazione {sn}", "s", "duration")
+            self.announce_diagnostic(f"{sn}_stale_polls", f"Polling a vuoto {sn}", state_class="total_increasing")
+            self.announce_diagnostic(f"{sn}_history_sync", f"Durata sincronizzazione storico {sn}", "s", "duration")
+
+    def diagnostics(self):
+        # Latenze e durate: media dell'ultimo intervallo, non dall'avvio
+        m = self.metrics
+        flush = m.interval_mean("peimar_outbox_flush_seconds")
+        stato = {"mqtt_published": m.counter("peimar_mqtt_published"),
+                 "outbox_depth": len(self.outbox) if self.outbox is not None else 0,
+                 "outbox_flush_ms": round(flush * 1000) if flush is not None else None}
+        for endpoint in PORTAL_ENDPOINTS:
+            media = m.interval_mean("peimar_http_request_seconds", endpoint=endpoint)
+            stato[f"http_{endpoint}_ms"] = round(media * 1000) if media is not None else None
+            stato[f"http_{endpoint}_errors"] = (m.counter("peimar_http_errors", endpoint=endpoint)
+                                                + m.counter("peimar_http_timeouts", endpoint=endpoint))
+        for dev in self.devices:
+            sn = dev.DEVICE_SN
+            durata = m.interval_mean("peimar_history_sync_seconds", device=sn)
+            stato[f"{sn}_data_age"] = m.gauge("peimar_data_age_seconds", device=sn)
+            stato[f"{sn}_poll_to_publish"] = m.gauge("peimar_last_poll_to_publish_seconds", device=sn)
+            stato[f"{sn}_stale_polls"] = m.counter("peimar_stale_polls", device=sn)
+            stato[f"{sn}_history_sync"] = round(durata, 1) if durata is not None else None
+        return stato
+
+    def job_diagnostics(self):
+        self.publish(self.DIAGNOSTICS_TOPIC, json.dumps(self.diagnostics()), retain=True)
+        return time.time() + self.DIAGNOSTICS_INTERVAL
+
+    def start_prometheus(self):
+        metrics = self.metrics
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                body = metrics.prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        server = ThreadingHTTPServer(("0.0.0.0", self.PROMETHEUS_PORT), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True, name="peimar-metrics").start()
+        self.log(f"📈 Metriche Prometheus su :{self.PROMETHEUS_PORT}/metrics")
+
+    def load_discovery_cache(self):
+        try:
+            with open(self.DISCOVERY_CACHE_PATH, "r") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def save_discovery_cache(self, cache):
         try:
-            self.session.post(f"{self.BASE}/portal/login", 
-                              data={"username": self.USERNAME, "password": self.PASSWORD}, timeout=30)
-            self.last_login = datetime.now()
-            self.log("🔐 Login Peimar OK")
+            tmp_path = f"{self.DISCOVERY_CACHE_PATH}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(cache, f)
+            os.replace(tmp_path, self.DISCOVERY_CACHE_PATH)
         except Exception as e:
-            self.log(f"❌ Login Fallito: {e}")
+            self.log(f"❌ Errore scrittura cache discovery: {e}")
+
+    def announce_device(self, dev):
+        for sensor in SENSORS:
+            if sensor.discovery:
+                self.announce_sensor(dev, sensor)
+        for sensor in self.AGGREGATE_SENSORS:
+            for minuti in self.AGGREGATE_WINDOWS:
+                self.announce_statistics(dev, sensor, minuti)
+
+    def announce_statistics(self, dev, sensor, minuti):
+        # Un sensore per statistica, tutti letti dallo stesso messaggio JSON della finestra
+        chiave = f"{sensor.topic.replace('/', '_')}_{minuti}m"
+        for stat, nome, unit, dev_class, state_class in (
+                ("mean", "media", sensor.unit, sensor.dev_class, "measurement"),
+                ("min", "minimo", sensor.unit, sensor.dev_class, "measurement"),
+                ("max", "massimo", sensor.unit, sensor.dev_class, "measurement"),
+                ("energy", "energia", "Wh", "energy", None)):
+            payload = {
+                "name": f"{sensor.name} {nome} {minuti} min",
+                "state_topic": f"{dev.TOPIC}/stats/{chiave}",
+                "value_template": f"{{{{ value_json.{stat} }}}}",
+                "unique_id": f"peimar_{dev.DEVICE_SN}_{chiave}_{stat}",
+                "unit_of_measurement": unit,
+                **self.device_availability(dev),
+                "device_class": dev_class,
+                "device": {
+                    "identifiers": [f"peimar_inverter_{dev.DEVICE_SN}"],
+                    "name": dev.NAME,
+                    "manufacturer": "Peimar"
+                }
+            }
+            if state_class: payload["state_class"] = state_class
+            discovery_topic = f"homeassistant/sensor/{self.MQTT_PREFIX}/{dev.DEVICE_SN}_{chiave}_{stat}/config"
+            self.device_discovery[discovery_topic] = json.dumps(payload, sort_keys=True)
+
+    def aggregate(self, dev, ts, values):
+        for (topic, minuti), aggregator in dev.aggregators.items():
+            value = values.get(topic)
+            if not isinstance(value, (int, float)):
+                continue
+            completed = aggregator.add(ts, float(value))
+            if completed:
+                self.publish(f"{dev.TOPIC}/stats/{topic.replace('/', '_')}_{minuti}m", json.dumps(completed), retain=True)
+
+    def http_get(self, url, **kwargs):
+        return self.http_request("GET", url, **kwargs)
+
+    def http_post(self, url, **kwargs):
+        return self.http_request("POST", url, **kwargs)
+
+    def http_request(self, method, url, check_session=True, retry=True, **kwargs):
+        # Tutte le richieste al portale passano da qui: il semaforo limita quelle in volo
+        # indipendentemente da quanti inverter o job le stanno generando
+        endpoint = url.rsplit("/", 1)[-1]
+        self.breaker.check()
+        generation = self.login_generation
+        with self.http_slots:
+            start = time.perf_counter()
+            try:
+                r = self.session.request(method, url, **kwargs)
+            except requests.Timeout:
+                self.metrics.inc("peimar_http_timeouts", endpoint=endpoint)
+                self.breaker.failure()
+                raise
+            except Exception:
+                self.metrics.inc("peimar_http_errors", endpoint=endpoint)
+                self.breaker.failure()
+                raise
+            finally:
+                self.metrics.observe("peimar_http_request_seconds", time.perf_counter() - start, endpoint=endpoint)
+
+        # Un 5xx (anche una pagina HTML di un proxy) è un guasto del portale, non una sessione scaduta
+        if r.status_code >= 500:
+            self.metrics.inc("peimar_http_errors", endpoint=endpoint)
+            self.breaker.failure()
+            return r
+
+        if check_session and self.is_session_expired(r):
+            self.metrics.inc("peimar_session_expired", endpoint=endpoint)
+            if retry:
+                # Un solo re-login condiviso tra tutte le richieste scadute in contemporanea, poi si riprova;
+                # il breaker si richiude solo se il nuovo tentativo va a buon fine
+                self.log(f"🔑 Sessione scaduta ({endpoint}), nuovo login")
+                self.relogin_state.active = True
+                try:
+                    self.relogin(generation)
+                finally:
+                    self.relogin_state.active = False
+                return self.http_request(method, url, check_session=True, retry=False, **kwargs)
+            self.breaker.failure()
+            raise SessionExpired(f"sessione non valida dopo il login ({endpoint})")
+
+        if r.status_code >= 400:
+            self.metrics.inc("peimar_http_errors", endpoint=endpoint)
+        if not getattr(self.relogin_state, "active", False):
+            self.breaker.success()
+        return r
+
+    def is_session_expired(self, r):
+        # Sessione scaduta: redirect verso la pagina di login, HTML al posto del JSON, codici di autenticazione
+        if r.status_code in (401, 403):
+            return True
+        if r.status_code >= 400:
+            return False
+        if r.history and "login" in r.url:
+            return True
+        content_type = r.headers.get("Content-Type", "")
+        if "text/html" in content_type:
+            return True
+        if "json" in content_type and len(r.content) < 512:
+            try:
+                data = r.json()
+            except ValueError:
+                return False
+            return isinstance(data, dict) and str(data.get("code")) in self.AUTH_ERROR_CODES
+        return False
+
+    def relogin(self, generation):
+        with self.login_lock:
+            if self.login_generation == generation:
+                self.login()
+
+    def publish(self, topic, payload, retain=False):
+        # True se il messaggio è stato consegnato a paho o accodato, False se è andato perso
+        self.metrics.inc("peimar_mqtt_published")
+        if self.outbox is None:
+            return self.mqttc.publish(topic, payload, retain=retain).rc == mqtt.MQTT_ERR_SUCCESS
+        # Finché la coda non è vuota si accoda anche a broker collegato, per non superare i messaggi in attesa
+        if not len(self.outbox) and self.mqttc.is_connected():
+            if self.mqttc.publish(topic, payload, retain=retain).rc == mqtt.MQTT_ERR_SUCCESS:
+                return True
+        try:
+            self.outbox.put(topic, payload, retain)
+            return True
+        except OSError as e:
+            self.log(f"❌ Errore scrittura coda MQTT: {e}")
+            return False
+        finally:
+            self.metrics.set("peimar_outbox_depth", len(self.outbox))
+
+    def job_flush_outbox(self):
+        # Svuota la coda a lotti; se il broker cade di nuovo i messaggi restano per la prossima connessione
+        inviati = 0
+        with self.metrics.timer("peimar_outbox_flush_seconds"):
+            while self.mqttc.is_connected():
+                lotto = self.outbox.peek(self.OUTBOX_BATCH)
+                if not lotto:
+                    break
+                consegnati = []
+                for key, item in lotto:
+                    topic, payload, retain = item
+                    if self.mqttc.publish(topic, payload, retain=retain).rc != mqtt.MQTT_ERR_SUCCESS:
+                        break
+                    consegnati.append((key, item))
+                self.outbox.ack(consegnati)
+                inviati += len(consegnati)
+                if len(consegnati) < len(lotto):
+                    break
+                time.sleep(self.OUTBOX_BATCH_DELAY)
+        self.metrics.set("peimar_outbox_depth", len(self.outbox))
+        self.metrics.set("peimar_outbox_dropped", self.outbox.dropped)
+        if inviati:
+            self.log(f"📬 Inviati {inviati} messaggi MQTT rimasti in coda ({len(self.outbox)} ancora in attesa)")
+        return None
+
+    def login(self):
+        with self.login_lock:
+            try:
+                r = self.http_post(f"{self.BASE}/portal/login", check_session=False,
+                                   data={"username": self.USERNAME, "password": self.PASSWORD}, timeout=30)
+                r.raise_for_status()
+                self.last_login = datetime.now()
+                self.login_generation += 1
+                self.invalidate_cache()
+                self.log("🔐 Login Peimar OK")
+            except Exception as e:
+                self.log(f"❌ Login Fallito: {e}")
+
+    def device_availability(self, dev):
+        # I sensori di un inverter sono disponibili se il bridge è in linea (LWT) e la sua sorgente attiva risponde
+        return {"availability": [{"topic": self.AVAILABILITY_TOPIC}, {"topic": f"{dev.TOPIC}/availability"}],
+                "availability_mode": "all"}
+
+    def source_available(self, dev):
+        if dev.local is not None and dev.local_failures < self.LOCAL_MAX_FAILURES:
+            return True
+        return not self.breaker.is_open()
+
+    def publish_availability(self, dev):
+        self.publish(f"{dev.TOPIC}/availability", "online" if self.source_available(dev) else "offline", retain=True)
+
+    def set_availability(self, online):
+        self.log("🟢 Portale Peimar di nuovo raggiungibile" if online else "🔴 Portale Peimar non raggiungibile, richieste sospese")
+        for dev in self.devices:
+            self.publish_availability(dev)
+
+    def on_connect(self, client, userdata, flags, reason_code, properties):
+        # Le sottoscrizioni vanno rinnovate ad ogni (ri)connessione
+        self.mqttc.subscribe("homeassistant/input_select/peimar_history_period/set")
+        self.mqttc.subscribe("homeassistant/status")
+        self.publish(self.AVAILABILITY_TOPIC, "online", retain=True)
+        for dev in self.devices:
+            self.publish_availability(dev)
+        if self.outbox is not None and len(self.outbox):
+            self.scheduler.schedule("coda mqtt", time.time(), self.job_flush_outbox)
+        if self.discovery_pending:
+            self.scheduler.schedule("discovery", time.time(), self.setup_discovery)
 
     def on_message(self, client, userdata, msg):
+        if msg.topic == "homeassistant/status":
+            # HA riavviato: potrebbe aver perso i retained, si ripubblica tutta la discovery
+            if msg.payload.decode().strip() == "online":
+                self.executor.submit(self.setup_discovery, True)
+            return
         try:
-            mese_scelto = msg.payload.decode().strip()
-            if '-' not in mese_scelto or len(mese_scelto) < 6:
+            periodo = msg.payload.decode().strip()
+            intervallo = self.parse_period(periodo, date.today())
+            if intervallo is None:
                 return
 
-            self.log(f"📩 HA richiede dati per: {mese_scelto}")
-            history = self.load_local_history()
-            y_req, m_req = mese_scelto.split('-')
-            m_req = str(int(m_req)) 
-
-            if y_req in history and m_req in history[y_req]:
-                d = history[y_req][m_req]
-                self.mqttc.publish("peimar/history/selected/pv", d['pv'], retain=True)
-                self.mqttc.publish("peimar/history/selected/use", d['use'], retain=True)
-                self.mqttc.publish("peimar/history/selected/buy", d['buy'], retain=True)
-                self.mqttc.publish("peimar/history/selected/sell", d['sell'], retain=True)
-                self.log(f"✅ Dati di {mese_scelto} pubblicati.")
+            self.log(f"📩 HA richiede dati per: {periodo}")
+            for dev in self.devices:
+                dev.history.refresh(functools.partial(self.load_local_history, dev))
+                d = dev.history.total(*intervallo)
+                if d is None:
+                    continue
+                for base in self.history_topics(dev):
+                    self.publish(f"{base}/selected/pv", d['pv'], retain=True)
+                    self.publish(f"{base}/selected/use", d['use'], retain=True)
+                    self.publish(f"{base}/selected/buy", d['buy'], retain=True)
+                    self.publish(f"{base}/selected/sell", d['sell'], retain=True)
+                self.log(f"✅ Dati di {periodo} pubblicati.")
         except Exception as e:
             self.log(f"❌ Errore callback MQTT: {e}")
+
+    def parse_period(self, periodo, today):
+        # Formati accettati: "YYYY-MM", "YYYY", "YTD" e intervalli "YYYY-MM:YYYY-MM"
+        try:
+            if periodo.upper() == "YTD":
+                return (today.year, 1), (today.year, today.month)
+            if ":" in periodo:
+                inizio, fine = (self.parse_period(p.strip(), today) for p in periodo.split(":", 1))
+                return (inizio[0], fine[1]) if inizio and fine else None
+            if "-" in periodo:
+                y_req, m_req = periodo.split("-")
+                return (int(y_req), int(m_req)), (int(y_req), int(m_req))
+            if len(periodo) == 4:
+                return (int(periodo), 1), (int(periodo), 12)
+        except ValueError:
+            pass
+        return None
     
     # =====================================================================================
     # Scarica i dati dal portale e li conserve nei dizionari plant{}, Live{}, raw{}, bean{}
     # =====================================================================================
 
-    def fetch_data(self):
+    def fetch_plant(self, dev, ts, oggi):
+        r = self.http_post(f"{self.BASE}/portal/monitor/site/getPlantDetailInfo", 
+                           data={"plantuid": dev.PLANT_UID, "clientDate": oggi, "_t": ts},
+                           timeout=self.HTTP_TIMEOUTS["plant"])
+        dev.plant = r.json().get("plantDetail", {})
+
+    def fetch_live(self, dev, ts, oggi):
+        r = self.http_get(f"{self.BASE}/portal/monitor/site/getStoreOrAcDevicePowerInfo", 
+                          params={"plantuid": dev.PLANT_UID, "devicesn": dev.DEVICE_SN, "_t": ts},
+                          timeout=self.HTTP_TIMEOUTS["live"])
+        dev.live = r.json().get("storeDevicePower", {})
+        dev.portal_ts = dev.live.get("updateDate", 0)
+
+    def fetch_raw(self, dev, ts, oggi):
+        r = self.http_get(f"{self.BASE}/portal/cloudMonitor/deviceInfo/findRawdataPageList", 
+                          params={"deviceSn": dev.DEVICE_SN, "deviceType": "1", "timeStr": oggi, "_": ts},
+                          timeout=self.HTTP_TIMEOUTS["raw"])
+        raw_list = r.json().get("list", [])
+        if raw_list:
+            dev.raw = raw_list[0]
+
+    def fetch_bean(self, dev, ts, oggi):
+        # VIEW BEAN (Dati energetici storici/giornalieri)
+        params_bean = self.day_chart_params(dev, date.fromisoformat(oggi), ts)
+        try:
+            r_bean = self.http_get(f"{self.BASE}/portal/monitor/site/getPlantDetailChart2",
+                                   params=params_bean, timeout=self.HTTP_TIMEOUTS["bean"])
+        except Exception:
+            dev.bean = {} # Reset del bean per non usare dati vecchi o nulli
+            raise
+
+        # --- IL CONTROLLO DI SICUREZZA ---
+        if r_bean.status_code == 200:
+            # Solo se il server risponde "OK" (200), provo a leggere il JSON
+            try:
+                dev.bean = r_bean.json().get("viewBean")
+            except Exception as e:
+                self.log(f"⚠️ Errore nel formato JSON ricevuto: {e}")
+                dev.bean = {} # Evita che lo script si rompa se il JSON è malformato
+        else:
+            self.log(f"⚠️ Portale Peimar momentaneamente non raggiungibile (Status: {r_bean.status_code})")
+            dev.bean = {} # Reset del bean per non usare dati vecchi o nulli
+
+    def day_chart_params(self, dev, giorno, ts):
+        # Parametri di getPlantDetailChart2 per i totali di un giorno (chartDateType=1)
+        return {
+            "plantuid": dev.PLANT_UID,
+            "chartDateType": "1",
+            "energyType": "0",
+            "clientDate": giorno.isoformat(),
+            "deviceSnArr": dev.DEVICE_SN,
+            "chartCountType": "2",
+            "previousChartDay": (giorno - timedelta(days=1)).isoformat(),
+            "nextChartDay": (giorno + timedelta(days=1)).isoformat(),
+            "chartDay": giorno.isoformat(),
+            "elecDevicesn": dev.DEVICE_SN,
+            "_": ts
+        }
+
+    def fetch_data(self, dev, endpoints=("plant", "live", "raw", "bean")):
+        # Le chiamate sono indipendenti: partono in parallelo sul pool condiviso,
+        # così la durata del ciclo è quella della chiamata più lenta.
         ts = int(time.time() * 1000)
         oggi = date.today().isoformat()
-        ieri = (date.today() - timedelta(days=1)).isoformat()
-        domani = (date.today() + timedelta(days=1)).isoformat()
-        try:
-            # 1. PLANT
-            r = self.session.post(f"{self.BASE}/portal/monitor/site/getPlantDetailInfo", 
-                                  data={"plantuid": self.PLANT_UID, "clientDate": date.today().isoformat(), "_t": ts})
-            self.plant = r.json().get("plantDetail", {})
-            #print(self.plant)
-            # print("Dati Plant Ok")
-
-            # 2. LIVE
-            r = self.session.get(f"{self.BASE}/portal/monitor/site/getStoreOrAcDevicePowerInfo", 
-                                 params={"plantuid": self.PLANT_UID, "devicesn": self.DEVICE_SN, "_t": ts})
-            self.live = r.json().get("storeDevicePower", {})
-            #print(self.live)
-            # print("Dati Live Ok")
-
-            # 3. RAW
-            r = self.session.get(f"{self.BASE}/portal/cloudMonitor/deviceInfo/findRawdataPageList", 
-                                 params={"deviceSn": self.DEVICE_SN, "deviceType": "1", "timeStr": date.today().isoformat(), "_": ts})
-            raw_list = r.json().get("list", [0])
-            if raw_list:
-                self.raw = raw_list[0]
-            #print(self.raw)
-            # print("Dati Raw Ok")
-            
-            # 4. VIEW BEAN (Dati energetici storici/giornalieri)
-            url_bean = f"{self.BASE}/portal/monitor/site/getPlantDetailChart2"
-            params_bean = {
-                "plantuid": self.PLANT_UID,
-                "chartDateType": "1",
-                "energyType": "0",
-                "clientDate": oggi,
-                "deviceSnArr": self.DEVICE_SN,
-                "chartCountType": "2",
-                "previousChartDay": ieri,
-                "nextChartDay": domani,
-                "chartDay": oggi,
-                "elecDevicesn": self.DEVICE_SN,
-                "_": ts
-            }
-            r_bean = self.session.get(url_bean, params=params_bean, timeout=30)
-            
-            # --- IL CONTROLLO DI SICUREZZA ---
-            if r_bean.status_code == 200:
-                # Solo se il server risponde "OK" (200), provo a leggere il JSON
-                try:
-                    self.bean = r_bean.json().get("viewBean")
-                    # print("Dati Bean Ok")
-                    #print(self.bean)
-                except Exception as e:
-                    self.log(f"⚠️ Errore nel formato JSON ricevuto: {e}")
-                    self.bean = {} # Evita che lo script si rompa se il JSON è malformato
-            else:
-                self.log(f"⚠️ Portale Peimar momentaneamente non raggiungibile (Status: {r_bean.status_code})")
-                self.bean = {} # Reset del bean per non usare dati vecchi o nulli
-            
-            
+        endpoints = [name for name in endpoints if self.needs_fetch(dev, name, oggi)]
+        jobs = {name: self.executor.submit(getattr(self, f"fetch_{name}"), dev, ts, oggi) for name in endpoints}
+        errori = 0
+        for name, job in jobs.items():
+            try:
+                job.result()
+                dev.fetched[name] = (time.time(), oggi)
+            except Exception as e:
+                errori += 1
+                self.log(f"❌ Errore fetch {name}: {e}")
+
+        if not jobs:
+            return
+        if errori == 0:
             self.log("📡 Dati scaricati correttamente")
-           
+        elif errori < len(jobs):
+            self.log(f"⚠️ Dati scaricati parzialmente ({len(jobs) - errori}/{len(jobs)})")
+
+    def needs_fetch(self, dev, name, oggi):
+        # Gli endpoint da cui non dipende nessun topic pubblicato non vengono scaricati;
+        # gli altri restano in cache per il loro TTL, ma mai oltre il cambio giorno
+        if name not in self.USED_ENDPOINTS:
+            return False
+        ttl = self.CACHE_TTL.get(name, 0)
+        if not ttl or name not in dev.fetched:
+            return True
+        fetched_at, giorno = dev.fetched[name]
+        return giorno != oggi or time.time() - fetched_at >= ttl
+
+    def invalidate_cache(self):
+        for dev in self.devices:
+            dev.fetched.clear()
+
+    # =====================================================================================
+    # Ingestione completa dei record raw della giornata (findRawdataPageList è paginato,
+    # dal più recente). Si ricorda l'ultimo timestamp acquisito e, dopo un riavvio, si
+    # recuperano anche i giorni mancanti, al massimo RAW_BACKFILL_DAYS.
+    # =====================================================================================
+
+    def raw_record_ts(self, record):
+        for key in RAW_TIME_KEYS:
+            value = record.get(key)
+            if isinstance(value, (int, float)):
+                return value / 1000.0 if value > 1e11 else float(value)
+            if isinstance(value, str) and value:
+                try:
+                    return datetime.fromisoformat(value).timestamp()
+                except ValueError:
+                    continue
+        return None
+
+    def raw_pages(self, dev, giorno):
+        # Pagine di record di un giorno, dalla più recente; si ferma alla prima pagina incompleta
+        page = 1
+        while True:
+            r = self.http_get(f"{self.BASE}/portal/cloudMonitor/deviceInfo/findRawdataPageList",
+                              params={"deviceSn": dev.DEVICE_SN, "deviceType": "1", "timeStr": giorno.isoformat(),
+                                      "pageNum": page, "pageSize": self.RAW_PAGE_SIZE, "_": int(time.time() * 1000)},
+                              timeout=self.HTTP_TIMEOUTS["raw"])
+            records = r.json().get("list") or []
+            yield records
+            if len(records) < self.RAW_PAGE_SIZE:
+                return
+            page += 1
+
+    def raw_records_since(self, dev, giorno, since):
+        # Record più recenti di `since`, in ordine cronologico. Le pagine arrivano dal più recente,
+        # quindi ci si ferma al primo record già acquisito; si accumula al massimo un giorno.
+        nuovi = []
+        for records in self.raw_pages(dev, giorno):
+            for record in records:
+                ts = self.raw_record_ts(record)
+                if ts is None:
+                    continue
+                if ts <= since:
+                    yield from reversed(nuovi)
+                    return
+                nuovi.append((ts, record))
+        yield from reversed(nuovi)
+
+    def raw_backlog(self, dev, since):
+        # Tutti i record successivi a `since`, giorno per giorno fino a oggi
+        giorno = max(datetime.fromtimestamp(since).date(), date.today() - timedelta(days=self.RAW_BACKFILL_DAYS))
+        while giorno <= date.today():
+            yield from self.raw_records_since(dev, giorno, since)
+            giorno += timedelta(days=1)
+
+    def ingest_raw(self, dev):
+        checkpoint = self.load_raw_checkpoint(dev)
+        if checkpoint is None:
+            checkpoint = datetime.combine(date.today(), datetime.min.time()).timestamp()
+        acquisiti, batch = 0, []
+        for ts, record in self.raw_backlog(dev, checkpoint):
+            values = self.record_values(record)
+            if self.sample_store:
+                self.sample_store.append(dev.DEVICE_SN, ts, values)
+            if self.RAW_BATCH_MQTT:
+                batch.append({"ts": ts, "values": values})
+                if len(batch) >= self.RAW_BATCH_SIZE:
+                    self.publish(f"{dev.TOPIC}/raw/batch", json.dumps(batch))
+                    batch = []
+            checkpoint = ts
+            acquisiti += 1
+            if acquisiti % self.RAW_BATCH_SIZE == 0:
+                self.save_raw_checkpoint(dev, checkpoint)
+        if batch:
+            self.publish(f"{dev.TOPIC}/raw/batch", json.dumps(batch))
+        self.save_raw_checkpoint(dev, checkpoint)
+        if acquisiti:
+            self.log(f"🧾 [{dev.DEVICE_SN}] Acquisiti {acquisiti} record raw")
+        return acquisiti
+
+    def record_values(self, record):
+        # Il record raw fa da dizionario live e raw insieme: i campi live (es. potenza di rete) e i segni
+        # dati da un campo direzione ci sono solo se il record li contiene. Gli altri vengono omessi
+        # (NaN nell'archivio) invece di essere salvati con segno o valore sbagliato.
+        values = self.compute_values(record, record)
+        return {s.topic: values[s.topic] for s in SENSORS
+                if s.topic in SAMPLE_FIELDS and s.topic in values and all(f in record for f in s.requires)}
+
+    def load_raw_checkpoint(self, dev):
+        try:
+            with open(dev.RAW_CHECKPOINT_PATH, "r") as f:
+                return json.load(f)["last_ts"]
+        except (FileNotFoundError, json.JSONDecodeError, KeyError):
+            return None
+
+    def save_raw_checkpoint(self, dev, ts):
+        try:
+            tmp_path = f"{dev.RAW_CHECKPOINT_PATH}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump({"last_ts": ts}, f)
+            os.replace(tmp_path, dev.RAW_CHECKPOINT_PATH)
         except Exception as e:
-            self.log(f"❌ Errore fetch: {e}")
+            self.log(f"❌ Errore scrittura checkpoint raw: {e}")
 
-    def fetch_full_history(self, start_year=2022):
-        self.log(f"🚀 Avvio recupero storico totale dal {start_year}...")
-        history = {}
+    def job_raw(self, dev):
+        self.ingest_raw(dev)
+        return time.time() + self.RAW_INGEST_INTERVAL
+
+    # =====================================================================================
+    # Storico mensile: i mesi passati non cambiano, quindi vengono marcati "final" in
+    # peimar_history.json e non più riscaricati. Ogni notte si aggiorna solo il mese
+    # corrente (e il precedente nei primi giorni dopo il cambio mese).
+    # =====================================================================================
+
+    def fetch_month(self, dev, year, month):
         url = f"{self.BASE}/portal/monitor/site/getPlantDetailChart2"
-        now = datetime.now()
-        
-        for year in range(start_year, now.year + 1):
-            history[str(year)] = {} 
-            end_month = now.month if year == now.year else 12
-            for month in range(1, end_month + 1):
-                ts = int(time.time() * 1000)
-                month_str = f"{year}-{month:02d}"
-                params = {
-                    "plantuid": self.PLANT_UID,
-                    "chartDateType": "2",
-                    "energyType": "0",
-                    "clientDate": f"{month_str}-01",
-                    "deviceSnArr": self.DEVICE_SN,
-                    "chartCountType": "2",
-                    "chartMonth": month_str,
-                    "chartYear": str(year),
-                    "elecDevicesn": self.DEVICE_SN,
-                    "_": ts
-                }
+        month_str = f"{year}-{month:02d}"
+        params = {
+            "plantuid": dev.PLANT_UID,
+            "chartDateType": "2",
+            "energyType": "0",
+            "clientDate": f"{month_str}-01",
+            "deviceSnArr": dev.DEVICE_SN,
+            "chartCountType": "2",
+            "chartMonth": month_str,
+            "chartYear": str(year),
+            "elecDevicesn": dev.DEVICE_SN,
+            "_": int(time.time() * 1000)
+        }
+        try:
+            r = self.http_get(url, params=params, timeout=30)
+            data = r.json().get("viewBean", {})
+        except Exception as e:
+            self.log(f"⚠️ Errore mese {month_str}: {e}")
+            return None
+        if data and any(v is not None for v in [data.get("pvElec"), data.get("useElec")]):
+            return {
+                "pv": self.clean_value(data.get("pvElec")),
+                "use": self.clean_value(data.get("useElec")),
+                "buy": self.clean_value(data.get("buyElec")),
+                "sell": self.clean_value(data.get("sellElec"))
+            }
+        return None
+
+    def is_month_final(self, year, month, today):
+        # Un mese è definitivo quando sono passati HISTORY_GRACE_DAYS dall'inizio del mese successivo
+        next_month = date(year + month // 12, month % 12 + 1, 1)
+        return today >= next_month + timedelta(days=self.HISTORY_GRACE_DAYS)
+
+    def months_to_sync(self, history, start_year, today):
+        # Se lo storico esiste si parte dal primo mese noto, altrimenti da start_year
+        known = [(int(y), int(m)) for y in history for m in history[y]]
+        year, month = min(known) if known else (start_year, 1)
+        months = []
+        while (year, month) <= (today.year, today.month):
+            entry = history.get(str(year), {}).get(str(month))
+            if not (entry and entry.get("final")):
+                months.append((year, month))
+            year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+        return months
+
+    def sync_history(self, dev, history, start_year=2022):
+        with self.metrics.timer("peimar_history_sync_seconds", device=dev.DEVICE_SN):
+            if self.HISTORY_DAILY:
+                return self._sync_history_daily(dev, history, start_year)
+            return self._sync_history(dev, history, start_year)
+
+    def _sync_history(self, dev, history, start_year):
+        today = date.today()
+        months = self.months_to_sync(history, start_year, today)
+        self.log(f"🔄 Sincronizzazione storico: {len(months)} mesi da aggiornare")
+
+        for i, (year, month) in enumerate(months):
+            if i:
+                time.sleep(self.HISTORY_REQUEST_DELAY)
+            data = self.fetch_month(dev, year, month)
+            if data is None:
+                continue
+            if self.is_month_final(year, month, today):
+                data["final"] = True
+            history.setdefault(str(year), {})[str(month)] = data
+
+        # Filtriamo gli anni che sono rimasti vuoti
+        return {k: v for k, v in history.items() if v}, len(months)
+
+    # =====================================================================================
+    # Storico giornaliero: un file JSON per mese ({giorno: valori}) riscritto in modo atomico
+    # dopo ogni giorno scaricato, così un recupero interrotto riparte dai giorni mancanti.
+    # =====================================================================================
+
+    def fetch_day(self, dev, giorno):
+        # Stessa chiamata del view bean di fetch_bean, per un giorno qualsiasi
+        params = self.day_chart_params(dev, giorno, int(time.time() * 1000))
+        r = self.http_get(f"{self.BASE}/portal/monitor/site/getPlantDetailChart2", params=params, timeout=30)
+        data = r.json().get("viewBean", {})
+        if data and any(v is not None for v in [data.get("pvElec"), data.get("useElec")]):
+            return {k: self.clean_value(data.get(f"{k}Elec")) for k in HistoryIndex.KEYS}
+        return None
+
+    def daily_path(self, dev, year, month):
+        return f"{dev.DAILY_DIR}/{year}-{month:02d}.json"
+
+    def load_daily(self, dev, year, month):
+        try:
+            with open(self.daily_path(dev, year, month), "r") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def save_daily(self, dev, year, month, giorni):
+        os.makedirs(dev.DAILY_DIR, exist_ok=True)
+        path = self.daily_path(dev, year, month)
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(giorni, f, indent=1, sort_keys=True)
+        os.replace(f"{path}.tmp", path)
+
+    def days_to_sync(self, dev, history, start_year, today):
+        # Tutti i giorni dal primo mese noto (o da start_year) a oggi non ancora definitivi su disco
+        mesi = {}
+        giorno = date(*min(((int(y), int(m)) for y in history for m in history[y]), default=(start_year, 1)), 1)
+        while giorno <= today:
+            chiave = (giorno.year, giorno.month)
+            if chiave not in mesi:
+                mesi[chiave] = self.load_daily(dev, *chiave)
+            if not mesi[chiave].get(giorno.isoformat(), {}).get("final"):
+                yield giorno, mesi[chiave]
+            giorno += timedelta(days=1)
+
+    def _sync_history_daily(self, dev, history, start_year):
+        today = date.today()
+        # Mesi da ricalcolare: tutti quelli dell'intervallo mancanti o non definitivi nello storico, non solo
+        # quelli con giorni scaricati ora (un recupero interrotto ha già salvato i giorni ma non i totali)
+        mesi = self.months_to_sync(history, start_year, today)
+        giorni = list(self.days_to_sync(dev, history, start_year, today))
+        self.log(f"🔄 Sincronizzazione storico giornaliero: {len(giorni)} giorni da aggiornare")
+        bucket = TokenBucket(self.BACKFILL_RATE, self.BACKFILL_WORKERS)
+
+        def scarica(giorno):
+            bucket.acquire()
+            return self.fetch_day(dev, giorno)
+
+        with ThreadPoolExecutor(max_workers=self.BACKFILL_WORKERS, thread_name_prefix="peimar-backfill") as pool:
+            futures = {pool.submit(scarica, giorno): (giorno, mese) for giorno, mese in giorni}
+            for completati, future in enumerate(as_completed(futures), 1):
+                giorno, mese = futures[future]
                 try:
-                    r = self.session.get(url, params=params, timeout=30)
-                    resp_data = r.json()
-                    
-                    # DEEP DEBUG: Vediamo la prima risposta utile
-                    if year == start_year and month == 1:
-                        self.log(f"🔍 DEBUG Risposta Portale: {resp_data}")
-
-                    data = resp_data.get("viewBean", {})
-                    if data and any(v is not None for v in [data.get("pvElec"), data.get("useElec")]):
-                        history[str(year)][str(month)] = {
-                            "pv": self.clean_value(data.get("pvElec")),
-                            "use": self.clean_value(data.get("useElec")),
-                            "buy": self.clean_value(data.get("buyElec")),
-                            "sell": self.clean_value(data.get("sellElec"))
-                        }
-                    else:
-                        # Logghiamo solo se non troviamo nulla per capire dove si ferma
-                        pass
-                    
-                    time.sleep(0.5) 
+                    data = future.result()
                 except Exception as e:
-                    self.log(f"⚠️ Errore mese {month_str}: {e}")
-        
-        # Filtriamo gli anni che sono rimasti vuoti
-        final_history = {k: v for k, v in history.items() if v}
-        return final_history
+                    self.log(f"⚠️ Errore giorno {giorno}: {e}")
+                    continue
+                definitivo = today >= giorno + timedelta(days=self.HISTORY_GRACE_DAYS)
+                if data is None:
+                    if not definitivo:
+                        continue
+                    # Giorno senza dati (es. prima dell'installazione): segnato come vuoto per non richiederlo più
+                    data = {"empty": True}
+                if definitivo:
+                    data["final"] = True
+                mese[giorno.isoformat()] = data
+                try:
+                    self.save_daily(dev, giorno.year, giorno.month, mese)   # Checkpoint del giorno
+                except OSError as e:
+                    self.log(f"❌ Errore scrittura storico giornaliero: {e}")
+                if completati % 100 == 0:
+                    self.log(f"⏳ Storico giornaliero: {completati}/{len(giorni)} giorni")
+
+        # Totali mensili calcolati dai giorni; il mese è definitivo solo se lo sono tutti i suoi giorni
+        for year, month in mesi:
+            giorni_mese = self.load_daily(dev, year, month)
+            if all(g.get("empty") for g in giorni_mese.values()):
+                continue   # Mese interamente senza dati: non compare nello storico
+            totale = {k: round(sum(g.get(k, 0.0) for g in giorni_mese.values()), 2) for k in HistoryIndex.KEYS}
+            fine = date(year + month // 12, month % 12 + 1, 1) - timedelta(days=1)
+            if (self.is_month_final(year, month, today) and len(giorni_mese) == fine.day
+                    and all(g.get("final") for g in giorni_mese.values())):
+                totale["final"] = True
+            history.setdefault(str(year), {})[str(month)] = totale
+
+        return {k: v for k, v in history.items() if v}, len(mesi)
+
+    def fetch_full_history(self, dev, start_year=2022):
+        self.log(f"🚀 Avvio recupero storico totale dal {start_year}...")
+        history, _ = self.sync_history(dev, {}, start_year=start_year)
+        return history
             
-    def load_local_history(self):
+    def load_local_history(self, dev):
         try:
-            with open(self.HISTORY_PATH, "r") as f:
+            with open(dev.HISTORY_PATH, "r") as f:
                 content = f.read().strip()
                 if not content: return {}
                 return json.loads(content)
         except (FileNotFoundError, json.JSONDecodeError):
             return {}
 
-    def save_local_history(self, history):
+    def save_local_history(self, dev, history):
         try:
-            with open(self.HISTORY_PATH, "w") as f:
+            tmp_path = f"{dev.HISTORY_PATH}.tmp"
+            with open(tmp_path, "w") as f:
                 json.dump(history, f, indent=4)
+            os.replace(tmp_path, dev.HISTORY_PATH)
+            dev.history.set(history, os.stat(dev.HISTORY_PATH).st_mtime_ns)
             self.log("💾 history.json salvato")
         except Exception as e:
             self.log(f"❌ Errore scrittura storico: {e}")
     
-    def print_ordered_history(self, history_data):
-        if not history_data:
+    def print_ordered_history(self, dev):
+        rows = dev.history.rows()
+        if not rows:
             self.log("📭 Nessun dato storico da mostrare.")
             return
 
@@ -306,187 +1973,280 @@ class PeimarTester():
         print(f"{'PERIODO':<15} | {'PRODOTTA':>12} | {'CONSUMATA':>12} | {'ACQUISTATA':>10} | {'VENDUTA':>10}")
         print("-"*75)
 
-        tot_gen = {"pv": 0.0, "use": 0.0, "buy": 0.0, "sell": 0.0}
-        
-        for y_key in sorted(history_data.keys(), key=lambda x: int(x)):
-            months_sorted = sorted(history_data[y_key].keys(), key=lambda x: int(x))
-            for m_key in months_sorted:
-                d = history_data[y_key][m_key]
-                periodo = "{}-{:02d}".format(y_key, int(m_key))
-                print(f"{periodo:<15} | {d['pv']:12.1f} | {d['use']:12.1f} | {d['buy']:10.1f} | {d['sell']:10.1f}")
-                for k in tot_gen: tot_gen[k] += d.get(k, 0.0)
-            print("-"*75)
+        for i, ((year, month), d) in enumerate(rows):
+            periodo = "{}-{:02d}".format(year, month)
+            print(f"{periodo:<15} | {d['pv']:12.1f} | {d['use']:12.1f} | {d['buy']:10.1f} | {d['sell']:10.1f}")
+            if i + 1 == len(rows) or rows[i + 1][0][0] != year:
+                print("-"*75)
 
+        tot_gen = dev.history.total(rows[0][0], rows[-1][0])
         print(f"{'TOTALE':<15} | {tot_gen['pv']:12.1f} | {tot_gen['use']:12.1f} | {tot_gen['buy']:10.1f} | {tot_gen['sell']:10.1f}")
         print("="*75 + "\n")
 
-    def update_ha_menu(self, history_data):
-        mesi_disponibili = []
-        if history_data:
-            years_sorted = sorted(history_data.keys(), key=lambda x: int(x))
-            for y in years_sorted:
-                months_sorted = sorted(history_data[y].keys(), key=lambda x: int(x))
-                for m in months_sorted:
-                    mesi_disponibili.append("{}-{:02d}".format(y, int(m)))
-        
-        mesi_disponibili.reverse() 
-        self.mqttc.publish("peimar/history/options", json.dumps(mesi_disponibili), retain=True)
+    def history_topics(self, dev):
+        # Il primo impianto pubblica anche sui topic storici senza seriale (peimar/history/...),
+        # così gli input_select e i sensori configurati prima del multi-impianto continuano a funzionare
+        topics = [f"{dev.TOPIC}/history"]
+        if dev is self.devices[0]:
+            topics.append(f"{self.MQTT_PREFIX}/history")
+        return topics
+
+    def update_ha_menu(self, dev):
+        # Mesi dal più recente, preceduti dagli aggregati: anno in corso (YTD) e anni interi
+        mesi_disponibili = ["{}-{:02d}".format(y, m) for (y, m), _ in reversed(dev.history.rows())]
+        anni = sorted({m[:4] for m in mesi_disponibili}, reverse=True)
+        opzioni = (["YTD"] if mesi_disponibili else []) + anni + mesi_disponibili
+        for base in self.history_topics(dev):
+            self.publish(f"{base}/options", json.dumps(opzioni), retain=True)
         self.log(f"✅ Inviata lista di {len(mesi_disponibili)} mesi a Home Assistant")
     
     def run(self):
+        self.start()
+        self.scheduler.run_forever()
+
+    def start(self):
+        if self.PROMETHEUS:
+            self.start_prometheus()
+        # Avvio a caldo: si ripubblica subito l'ultimo stato noto, poi login, discovery e storico
+        # locale partono insieme in background. Lo storico dal portale attende il primo polling.
+        for dev in self.devices:
+            self.warm_start(dev)
+        self.scheduler.schedule("login", time.time(), self.job_startup)
+        for dev in self.devices:
+            if dev.local is not None:
+                self.scheduler.schedule(f"locale {dev.DEVICE_SN}", time.time(), functools.partial(self.poll_local, dev))
+        self.scheduler.schedule("discovery", time.time(), self.job_discovery)
+        for dev in self.devices:
+            self.scheduler.schedule(f"storico locale {dev.DEVICE_SN}", time.time(), functools.partial(self.job_history_local, dev))
+        self.scheduler.schedule("diagnostica", time.time() + self.DIAGNOSTICS_INTERVAL, self.job_diagnostics)
+
+    # =====================================================================================
+    # Job dello scheduler: ciascuno restituisce l'orario (epoch) della prossima esecuzione
+    # =====================================================================================
+
+    def next_daily(self, hh_mm):
+        ore, minuti = map(int, hh_mm.split(":"))
+        now = datetime.now()
+        target = now.replace(hour=ore, minute=minuti, second=0, microsecond=0)
+        if target <= now:
+            target += timedelta(days=1)
+        return target.timestamp()
+
+    def poll_live(self, dev):
+        prossimo = self._poll_live(dev)
+        if not dev.history_started:
+            # Primo ciclo di polling completato: ora si può sincronizzare lo storico, poi ogni notte
+            dev.history_started = True
+            offset = self.devices.index(dev) * self.POLL_STAGGER
+            self.scheduler.schedule(f"storico {dev.DEVICE_SN}", time.time(),
+                                    functools.partial(self.job_history, dev, offset, avvio=True))
+        return prossimo
+
+    def _poll_live(self, dev):
+        if dev.local is not None and dev.local_failures < self.LOCAL_MAX_FAILURES:
+            return time.time() + self.LOCAL_INTERVAL   # La sorgente locale funziona: il portale non serve
+        if self.breaker.is_open():
+            return max(self.breaker.open_until, time.time() + ReleasePredictor.MIN_RETRY)
+        inizio = time.perf_counter()
+        # Sonda economica: solo getStoreOrAcDevicePowerInfo, che contiene updateDate.
+        # Gli altri endpoint vengono scaricati solo quando il portale ha davvero un dato nuovo.
+        if dev.last_processed_ts:
+            try:
+                self.fetch_live(dev, int(time.time() * 1000), date.today().isoformat())
+            except Exception as e:
+                self.log(f"❌ Errore fetch live: {e}")
+            if dev.portal_ts > dev.last_processed_ts:
+                self.fetch_data(dev, ("plant", "raw", "bean"))
+        else:
+            self.fetch_data(dev)
+
+        # Si confronta solo l'orario del portale: dev.live può contenere l'ultima lettura locale
+        current_ts = dev.portal_ts
+        if current_ts:
+            self.metrics.set("peimar_data_age_seconds", round(time.time() - current_ts / 1000.0), device=dev.DEVICE_SN)
+        # Aggiunto spazio e controllo di sicurezza
+        ultimo_aggiornamento = datetime.fromtimestamp(current_ts / 1000.0).strftime('%H:%M:%S') if current_ts else "N/D"
+
+        if current_ts > dev.last_processed_ts:
+            # --- DATI NUOVI TROVATI ---
+            with self.metrics.timer("peimar_publish_seconds", device=dev.DEVICE_SN):
+                self.process_and_publish(dev)
+            self.metrics.observe("peimar_poll_to_publish_seconds", time.perf_counter() - inizio, device=dev.DEVICE_SN)
+            self.metrics.set("peimar_last_poll_to_publish_seconds", round(time.perf_counter() - inizio, 3), device=dev.DEVICE_SN)
+            dev.last_processed_ts = current_ts
+            dev.release.observe(current_ts / 1000.0, time.time())
+            self.save_snapshot(dev)
+
+            next_update_time = dev.release.next_poll(time.time())
+            self.log(f"✨ [{dev.DEVICE_SN}] Dati sincronizzati (Orario portale: {ultimo_aggiornamento})")
+            self.log(f"⏳ [{dev.DEVICE_SN}] Prossimo controllo tra {int(next_update_time - time.time())} secondi "
+                     f"(cadenza {dev.release.interval:.0f}s, ritardo {dev.release.lag:.0f}s).")
+            return next_update_time
+
+        # --- DATI ANCORA VECCHI ---
+        self.metrics.inc("peimar_stale_polls", device=dev.DEVICE_SN)
+        attesa = dev.release.retry_delay()
+        self.log(f"⏳ [{dev.DEVICE_SN}] Il portale non ha ancora rilasciato nuovi dati. Riprovo tra {attesa:.0f} secondi...")
+        return time.time() + attesa
+
+    def job_startup(self):
         self.login()
-        self.setup_discovery()
-        time.sleep(2)
-        self.mqttc.subscribe("homeassistant/input_select/peimar_history_period/set")
-    
-    # CARICAMENTO STORIA
-        storia = self.load_local_history()
-    
-    # Se la storia è vuota o il file ha solo {}, scarica tutto
-        if not storia or len(storia) == 0:
-            storia = self.fetch_full_history(start_year=2022)
+        # Polling e storico dei vari inverter sfasati di POLL_STAGGER secondi per non colpire il portale in blocco
+        for i, dev in enumerate(self.devices):
+            offset = i * self.POLL_STAGGER
+            self.scheduler.schedule(f"polling {dev.DEVICE_SN}", time.time() + offset, functools.partial(self.poll_live, dev))
+            if self.RAW_INGEST:
+                self.scheduler.schedule(f"raw {dev.DEVICE_SN}", time.time() + offset, functools.partial(self.job_raw, dev))
+        self.scheduler.schedule("login", time.time() + self.LOGIN_INTERVAL, self.job_login)
+        return None
+
+    def poll_local(self, dev):
+        # Lettura diretta dalla LAN; dopo LOCAL_MAX_FAILURES errori il polling cloud riprende da solo
+        try:
+            with self.metrics.timer("peimar_local_read_seconds", device=dev.DEVICE_SN):
+                live, raw = dev.local.read()
+        except Exception as e:
+            self.metrics.inc("peimar_local_errors", device=dev.DEVICE_SN)
+            dev.local_failures += 1
+            if dev.local_failures == self.LOCAL_MAX_FAILURES:
+                self.log(f"🔴 [{dev.DEVICE_SN}] Sorgente {dev.local.name} non raggiungibile ({e}), uso il portale")
+                self.publish_availability(dev)
+            return time.time() + self.LOCAL_INTERVAL
+        ripristino = dev.local_failures >= self.LOCAL_MAX_FAILURES
+        dev.local_failures = 0
+        if ripristino:
+            self.log(f"🟢 [{dev.DEVICE_SN}] Sorgente {dev.local.name} di nuovo raggiungibile")
+            self.publish_availability(dev)
+        # I campi non presenti nella mappa restano quelli dell'ultima lettura dal portale
+        dev.live = {**dev.live, **live}
+        dev.raw = {**dev.raw, **raw}
+        self.process_and_publish(dev, verbose=False)   # Ogni pochi secondi: niente log per ciclo
+        if time.time() - dev.snapshot_saved >= self.SNAPSHOT_INTERVAL:
+            self.save_snapshot(dev)
+        return time.time() + self.LOCAL_INTERVAL
+
+    def load_modbus_map(self):
+        try:
+            with open(self.MODBUS_MAP_PATH, "r") as f:
+                return [tuple(r) for r in json.load(f)]
+        except FileNotFoundError:
+            return MODBUS_REGISTERS
+
+    def job_login(self):
+        self.login()
+        return time.time() + self.LOGIN_INTERVAL
+
+    def job_history_local(self, dev):
+        # Menu e indice dallo storico già su disco, senza attendere il portale
+        dev.history.refresh(functools.partial(self.load_local_history, dev))
+        self.update_ha_menu(dev)
+        return None
+
+    def job_history(self, dev, offset=0, avvio=False):
+        # All'avvio: se lo storico è vuoto scarica tutto, altrimenti solo i mesi non ancora definitivi
+        self.log(f"📅 [{dev.DEVICE_SN}] Aggiornamento {'' if avvio else 'programmato '}dello storico...")
+        storia, scaricati = self.sync_history(dev, self.load_local_history(dev), start_year=2022)
+        if scaricati:
             if storia:
-                self.save_local_history(storia)
+                self.save_local_history(dev, storia)
             else:
-                self.log("⚠️ Attenzione: Il recupero dati non ha prodotto risultati.")
+                self.log(f"⚠️ Attenzione: Il recupero dati di {dev.DEVICE_SN} non ha prodotto risultati.")
+        self.update_ha_menu(dev)
+        prossimo = self.next_daily(self.HISTORY_SYNC_TIME) + offset
+        if avvio:
+            self.print_ordered_history(dev)
+            # Da qui in poi è il normale aggiornamento notturno
+            self.scheduler.schedule(f"storico {dev.DEVICE_SN}", prossimo, functools.partial(self.job_history, dev, offset))
+            return None
+        return prossimo
 
-        self.print_ordered_history(storia)
-        self.update_ha_menu(storia)
-              
-        last_processed_ts = 0   # Per ricordare l'ultima lettura utile
-    
-        while True:
-            # Aggiornamento programmato
-            ora_attuale = datetime.now().strftime("%H:%M")
-            if ora_attuale == "00:05":
-                self.log("📅 Aggiornamento programmato dello storico...")
-                nuova_storia = self.fetch_full_history(start_year=2022)
-                self.save_local_history(nuova_storia)
-                self.update_ha_menu(nuova_storia)
-                time.sleep(60) 
-        
-            if datetime.now() - self.last_login > timedelta(hours=6):
-                self.login()
-        
-            self.fetch_data()
-        
-            current_ts = self.live.get("updateDate", 0)
-            # Aggiunto spazio e controllo di sicurezza
-            ultimo_aggiornamento = datetime.fromtimestamp(current_ts / 1000.0).strftime('%H:%M:%S') if current_ts else "N/D"
-                
-            if current_ts > last_processed_ts:
-                # --- DATI NUOVI TROVATI ---
-                self.process_and_publish() 
-                last_processed_ts = current_ts
-            
-                next_update_time = (current_ts / 1000.0) + 315
-                sleep_time = int(next_update_time - time.time())
-            
-                if sleep_time < 10:
-                    sleep_time = 10
-                
-                self.log(f"✨ Dati sincronizzati (Orario portale: {ultimo_aggiornamento})")
-                self.log(f"⏳ Prossimo controllo tra {int(sleep_time)} secondi.")
-            
-                for _ in range(sleep_time):
-                    time.sleep(1)
-            else:
-                # --- DATI ANCORA VECCHI (Else ora è allineato correttamente) ---
-                self.log("⏳ Il portale non ha ancora rilasciato nuovi dati. Riprovo tra 30 secondi...")
-                for _ in range(30):
-                    time.sleep(1)
+    def job_discovery(self):
+        self.setup_discovery()
+        return time.time() + self.DISCOVERY_REFRESH
 
-    
-    def process_and_publish(self):
-        # Conversione orario
-        raw_ts = self.live.get("updateDate")
-        orario = datetime.fromtimestamp(raw_ts / 1000.0).strftime('%H:%M:%S') if raw_ts else "N/D"
-        # print(orario, "status/last_update_time" )
-
-        grid_power = self.live.get("gridPower")
-        grid_direction = self.live.get("gridDirection")
-        if grid_direction == -1 and grid_power > 0:
-            grid_power = -grid_power
-            stato_rete = "Immissione"
-        elif grid_direction == 1 and grid_power > 0:
-            stato_rete = "Esportazione"
-        else:
-            stato_rete ="Riposo"
-
-        battery_power = self.raw.get("batPower")
-        battery_direction = self.live.get("batteryDirection")
-        if battery_direction == -1:
-            battery_power = -battery_power
-            stato_batteria = "Batteria in carica" 
-        elif battery_direction == 1:
-            stato_batteria = "Batteria in scarica"
-        else:
-            stato_batteria = "Batteria a riposo"          
-        
-        energy_consumption_today = self.clean_value(self.raw.get("todayLoadEnergyStr"))
-        # print("Energia Consumata oggi", energy_consumption_today)
-        battery_voltage = self.raw.get("batVolt")
-        
-        # Mappatura
-        mapping = {
-            # ======== FOTOVOLTAICO ======================
-            "pv/solar_power": self.live.get("solarPower"),
-            "pv/power_now": self.raw.get("nowPrower"),
-            "pv/pv1_power": self.raw.get("pV1Power"),
-            "pv/pv2_power": self.raw.get("pV2Power"),
-            "pv/pv1_volt": self.raw.get("pV1Volt"),
-            "pv/pv2_volt": self.raw.get("pV2Volt"),
-            "pv/pv1_current": self.raw.get("pV1Curr"),
-            "pv/pv2_current": self.raw.get("pV2Curr"),
-            "pv/energy_today": self.raw.get("todayPVEnergy"),
-            
-            # ========= BATTERIA =========================
-            "battery/capacity": self.raw.get("batCapicity"),
-            "battery/soc": self.raw.get("batEnergyPercent"),
-            "battery/power_live": battery_power,
-            "battery/volt": self.raw.get("batVolt"),
-            "battery/current": self.raw.get("batCurr"),
-            "battery/today_charge_energy": self.raw.get("todayBatChgEnergy"),
-            "battery/today_discharge_energy": self.raw.get("todayBatDisEnergy"),
-            "battery/total_charge_energy": self.raw.get("totalBatChgEnergy"),
-            "battery/total_discharge_energy": self.raw.get("totalBatDisEnergy"),
-            "battery/battery_status": stato_batteria,
-            
-            # ================ CARICO CASA / RETE ===================
-            "house/load_live": self.raw.get("totalLoadPowerWatt"),
-            "house/energy_consumption_today": self.clean_value(self.raw.get("todayLoadEnergyStr")),
-            "house/import_today": self.raw.get("todayFeedInEnergy"),
-            "house/export_today": self.raw.get("todaySellEnergy"), 
-            "grid/power": grid_power,
-            "grid/grid_voltage": self.raw.get("rGridVolt"),
-            "grid/grid_current": self.raw.get("rGridCurr"),
-            "grid/grid_frequency": self.raw.get("rGridFreq"),
-            "grid/grid_status": stato_rete,
-                        
-            # ========== INVERTER ===================================
-            "inverter/deviceTemp": self.raw.get("deviceTemp"),
-
-            # ========== ENERGIA ===================================
-            
-            # ============== STATUS ================================
-            "status/last_update_time": orario,
-        }
-        
-        for topic, val in mapping.items():
+    def compute_values(self, live, raw):
+        # Valori da pubblicare per topic, calcolati dai dizionari live e raw del portale
+        dati = (live, raw)
+        values = {}
+        for topic, accessor in SENSOR_ACCESSORS:
+            val = accessor(dati)
             if val is not None:
-                # Se il topic riguarda tensioni (volt), correnti (curr) o frequenze,
-                # forziamo il valore a float e lo arrotondiamo a 2 decimali
-                if any(keyword in topic for keyword in ["volt", "current", "freq", "energy"]):
-                    try:
-                        val = round(float(val), 2)
-                    except:
-                        pass
-                # Pulizia se è stringa con %
-                if isinstance(val, str) and "%" in val: 
-                    val = float(val.replace('%', '').replace(',','.'))
-                self.mqttc.publish(f"{self.MQTT_PREFIX}/{topic}", val, retain=True)
-        
-        self.log(f"✅ MQTT Aggiornato ({orario})")
+                values[topic] = val
+        return values
+
+    # =====================================================================================
+    # Ultimo stato noto (dati del portale e valori pubblicati) salvato in /data dopo ogni
+    # pubblicazione e ripubblicato all'avvio, prima ancora del login.
+    # =====================================================================================
+
+    def save_snapshot(self, dev):
+        snapshot = {"saved_at": time.time(), "live": dev.live, "raw": dev.raw, "bean": dev.bean,
+                    "last_processed_ts": dev.last_processed_ts, "published": dev.published}
+        try:
+            tmp_path = f"{dev.SNAPSHOT_PATH}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(snapshot, f)
+            os.replace(tmp_path, dev.SNAPSHOT_PATH)
+            dev.snapshot_saved = time.time()
+        except Exception as e:
+            self.log(f"❌ Errore scrittura ultimo stato: {e}")
+
+    def warm_start(self, dev):
+        try:
+            with open(dev.SNAPSHOT_PATH, "r") as f:
+                snapshot = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return
+        if time.time() - snapshot.get("saved_at", 0) > self.SNAPSHOT_MAX_AGE:
+            return
+        dev.live, dev.raw, dev.bean = snapshot["live"], snapshot["raw"], snapshot["bean"]
+        dev.last_processed_ts = snapshot["last_processed_ts"]
+        dev.published = {topic: tuple(v) for topic, v in snapshot["published"].items()}
+        self.process_and_publish(dev, force=True)
+        self.log(f"♻️ [{dev.DEVICE_SN}] Ripubblicato l'ultimo stato noto")
+
+    def process_and_publish(self, dev, force=False, verbose=True):
+        raw_ts = dev.live.get("updateDate")
+        values = self.compute_values(dev.live, dev.raw)
+        orario = values["status/last_update_time"]
+
+        now = time.time()
+        changed = [topic for topic, val in values.items() if force or self.should_publish(dev, topic, val, now)]
+        # Si ricordano solo i valori davvero pubblicati: quelli persi a broker scollegato (senza coda)
+        # devono ripartire al ciclo successivo invece di attendere PUBLISH_MAX_AGE
+        if self.PUBLISH_MODE == "json":
+            # Un solo messaggio con lo stato completo, inviato solo se qualcosa è cambiato
+            if changed:
+                state = {topic.replace('/', '_'): val for topic, val in values.items()}
+                if not self.publish(f"{dev.TOPIC}/state", json.dumps(state), retain=True):
+                    changed = []
+        else:
+            changed = [topic for topic in changed if self.publish(f"{dev.TOPIC}/{topic}", values[topic], retain=True)]
+        for topic in changed:
+            dev.published[topic] = (values[topic], now)
+
+        if dev.aggregators and raw_ts:
+            self.aggregate(dev, raw_ts / 1000.0, values)
+
+        if self.sample_store and raw_ts and not self.RAW_INGEST:
+            try:
+                self.sample_store.append(dev.DEVICE_SN, raw_ts / 1000.0, values)
+            except Exception as e:
+                self.log(f"❌ Errore archivio campioni: {e}")
+
+        if verbose:
+            self.log(f"✅ [{dev.DEVICE_SN}] MQTT Aggiornato ({orario}, {len(changed)}/{len(values)} valori cambiati)")
+
+    def should_publish(self, dev, topic, val, now):
+        # Pubblica solo i valori cambiati; i float entro la banda morta (percentuale) contano come
+        # invariati. Dopo PUBLISH_MAX_AGE secondi il valore viene comunque ripubblicato.
+        last = dev.published.get(topic)
+        if last is None or now - last[1] >= self.PUBLISH_MAX_AGE:
+            return True
+        old = last[0]
+        if isinstance(val, float) and isinstance(old, (int, float)) and self.PUBLISH_DEADBAND:
+            return abs(val - old) > abs(old) * self.PUBLISH_DEADBAND / 100
+        return val != old
 
 
 if __name__ == "__main__":
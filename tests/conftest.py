@@ -0,0 +1,39 @@
+import json
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "peimar_bridge"))
+sys.path.insert(0, os.path.join(ROOT, "bench"))
+
+import peimar  # noqa: E402
+import peimar_bench  # noqa: E402
+
+
+@pytest.fixture
+def portal():
+    portal = peimar_bench.FakePortal().start()
+    yield portal
+    portal.stop()
+
+
+@pytest.fixture
+def make_bridge(tmp_path, monkeypatch, portal):
+    """Costruisce un PeimarTester sul finto portale, con MQTT sostituito dal registratore."""
+    monkeypatch.setenv("PEIMAR_DATA_DIR", str(tmp_path))
+    monkeypatch.setenv("PEIMAR_SHARE_DIR", str(tmp_path))
+    monkeypatch.setenv("PEIMAR_PORTAL_URL", portal.url)
+
+    def make(**options):
+        with open(tmp_path / "options.json", "w") as f:
+            json.dump(dict({"peimar_user": "test", "peimar_pass": "test", "mqtt_host": "127.0.0.1",
+                            "poll_stagger": 0}, **options), f)
+        bridge = peimar.PeimarTester()
+        bridge.mqttc.loop_stop()
+        bridge.mqttc = peimar_bench.MqttRecorder()
+        bridge.HISTORY_REQUEST_DELAY = 0
+        bridge.BACKFILL_RATE = 1000
+        return bridge
+    return make
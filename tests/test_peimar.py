@@ -0,0 +1,420 @@
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
+from datetime import time as dtime
+
+import pytest
+
+import peimar
+import peimar_bench
+
+
+def test_scheduler_runs_due_jobs_and_reschedules():
+    eseguiti = []
+    scheduler = peimar.Scheduler(ThreadPoolExecutor(max_workers=1), lambda msg: None)
+
+    def ripetuto():
+        eseguiti.append("ripetuto")
+        return time.time() if len(eseguiti) < 3 else None
+
+    scheduler.schedule("ripetuto", time.time(), ripetuto)
+    scheduler.schedule("futuro", time.time() + 3600, lambda: eseguiti.append("futuro"))
+    assert scheduler.run_pending() == 3
+    assert eseguiti == ["ripetuto"] * 3
+    assert [name for _, _, name, _ in scheduler.heap] == ["futuro"]
+
+
+def test_scheduler_retries_failed_job_later():
+    scheduler = peimar.Scheduler(ThreadPoolExecutor(max_workers=1), lambda msg: None)
+
+    def guasto():
+        raise RuntimeError("portale giù")
+
+    prima = time.time()
+    scheduler.schedule("guasto", prima, guasto)
+    assert scheduler.run_pending() == 1
+    when, _, name, _ = scheduler.heap[0]
+    assert name == "guasto" and when >= prima + scheduler.RETRY_DELAY
+
+
+def test_circuit_breaker_opens_and_lets_a_single_probe_through():
+    cambi = []
+    breaker = peimar.CircuitBreaker(threshold=3, base_delay=30, on_change=cambi.append)
+    for _ in range(3):
+        breaker.check()
+        breaker.failure()
+    assert breaker.is_open() and cambi == [False]
+    with pytest.raises(peimar.PortalUnavailable):
+        breaker.check()
+
+    breaker.open_until = 0   # Attesa scaduta: half-open
+    breaker.check()
+    breaker.check()          # Lo stesso thread può proseguire la prova
+    altro = []
+
+    def check_da_altro_thread():
+        try:
+            breaker.check()
+        except peimar.PortalUnavailable:
+            altro.append("bloccato")
+    t = threading.Thread(target=check_da_altro_thread)
+    t.start()
+    t.join()
+    assert altro == ["bloccato"]
+
+    breaker.success()
+    assert not breaker.is_open() and cambi == [False, True]
+
+
+def test_html_502_opens_the_breaker_without_relogin(portal, make_bridge):
+    bridge = make_bridge()
+    portal.outage = True
+    url = f"{bridge.BASE}/portal/monitor/site/getStoreOrAcDevicePowerInfo"
+    for _ in range(20):
+        try:
+            r = bridge.http_get(url)
+            assert r.status_code == 502
+        except peimar.PortalUnavailable:
+            pass
+    assert portal.requests == bridge.BREAKER_THRESHOLD
+    assert portal.by_endpoint.get("login") is None
+    assert bridge.breaker.is_open()
+    dev = bridge.devices[0]
+    assert (f"{dev.TOPIC}/availability", "offline", True) in bridge.mqttc.messages
+
+
+def test_probe_with_expired_session_logs_in_and_closes_the_breaker(portal, make_bridge):
+    bridge = make_bridge()
+    for _ in range(bridge.BREAKER_THRESHOLD):
+        bridge.breaker.failure()
+    bridge.breaker.open_until = 0
+    portal.expired = True
+    r = bridge.http_get(f"{bridge.BASE}/portal/monitor/site/getStoreOrAcDevicePowerInfo")
+    assert r.json()["storeDevicePower"]["updateDate"] == portal.update_ts
+    assert portal.by_endpoint["login"] == 1
+    assert not bridge.breaker.is_open()
+    assert bridge.breaker.trips == 0 and bridge.breaker.probing is None
+
+
+def test_mqtt_outbox_merges_retained_and_survives_restart(tmp_path):
+    path = str(tmp_path / "outbox.jsonl")
+    outbox = peimar.MqttOutbox(path, max_items=3)
+    outbox.put("peimar/sn/solar", "1.0", True)
+    outbox.put("peimar/sn/solar", "2.0", True)
+    outbox.put("peimar/sn/raw/batch", "a", False)
+    outbox.put("peimar/sn/raw/batch", "b", False)
+    assert len(outbox) == 3
+
+    outbox.put("peimar/sn/grid", "5", True)   # Oltre max_items: si scarta il più vecchio
+    assert outbox.dropped == 1
+    riaperta = peimar.MqttOutbox(path, max_items=3)
+    assert [item for _, item in riaperta.peek(10)] == [
+        ("peimar/sn/raw/batch", "a", False), ("peimar/sn/raw/batch", "b", False), ("peimar/sn/grid", "5", True)]
+
+    inviati = riaperta.peek(10)
+    riaperta.put("peimar/sn/grid", "6", True)   # Aggiornato durante l'invio: deve restare in coda
+    riaperta.ack(inviati)
+    assert [item for _, item in riaperta.peek(10)] == [("peimar/sn/grid", "6", True)]
+
+
+def test_history_index_totals_and_refresh(tmp_path):
+    path = tmp_path / "history.json"
+    path.write_text("{}")
+    index = peimar.HistoryIndex(str(path))
+    caricamenti = []
+    storia = {"2025": {"11": {"pv": 100.0, "use": 50.0, "buy": 10.0, "sell": 60.0},
+                       "12": {"pv": 80.0, "use": 70.0, "buy": 20.0, "sell": 30.0}},
+              "2026": {"1": {"pv": 90.0, "use": 60.0, "buy": 15.0, "sell": 45.0}}}
+
+    def loader():
+        caricamenti.append(1)
+        return storia
+    index.refresh(loader)
+    index.refresh(loader)   # File invariato: nessuna rilettura
+    assert len(caricamenti) == 1
+    assert index.total((2025, 12), (2026, 1)) == {"pv": 170.0, "use": 130.0, "buy": 35.0, "sell": 75.0}
+    assert index.total((2025, 1), (2025, 12))["pv"] == 180.0
+    assert index.total((2024, 1), (2024, 12)) is None
+
+
+def test_window_aggregator_energy_and_boundary_split():
+    costante = peimar.WindowAggregator(300)
+    assert costante.add(0, 1000) is None
+    assert costante.add(150, 1000) is None
+    finestra = costante.add(300, 1000)
+    assert finestra["energy"] == round(1000 * 300 / 3600, 2)
+    assert (finestra["mean"], finestra["min"], finestra["max"], finestra["samples"]) == (1000, 1000, 1000, 2)
+
+    rampa = peimar.WindowAggregator(300)
+    rampa.add(0, 0)
+    finestra = rampa.add(600, 600)   # Il tratto viene tagliato al confine (300 s, 300 W)
+    assert (finestra["start"], finestra["end"], finestra["energy"]) == (0, 300, 12.5)
+
+
+def test_modbus_source_reads_blocks_and_directions():
+    valori = {"solarPower": 3.2, "gridPower": -850, "batPower": 1200, "pV1Volt": 310.4, "todayPVEnergy": 12.34}
+    simulatore = peimar_bench.ModbusSimulator(peimar.MODBUS_REGISTERS, valori).start()
+    try:
+        sorgente = peimar.ModbusSource("127.0.0.1", simulatore.port)
+        live, raw = sorgente.read()
+        assert simulatore.requests == len(sorgente.blocks) < len(peimar.MODBUS_REGISTERS)
+        assert live["solarPower"] == 3.2
+        assert (live["gridPower"], live["gridDirection"]) == (850, -1)
+        assert (raw["batPower"], live["batteryDirection"]) == (1200, 1)
+        assert raw["pV1Volt"] == 310.4 and raw["todayPVEnergy"] == 12.34
+        sorgente.close()
+    finally:
+        simulatore.stop()
+
+
+@pytest.mark.parametrize("periodo, intervallo", [
+    ("2025-03", ((2025, 3), (2025, 3))),
+    ("2025", ((2025, 1), (2025, 12))),
+    ("ytd", ((2026, 1), (2026, 5))),
+    ("2024-11:2025-02", ((2024, 11), (2025, 2))),
+    ("marzo", None),
+    ("2025-xx", None),
+])
+def test_parse_period(make_bridge, periodo, intervallo):
+    assert make_bridge().parse_period(periodo, date(2026, 5, 17)) == intervallo
+
+
+def test_local_source_falls_back_to_the_portal(portal, make_bridge):
+    simulatore = peimar_bench.ModbusSimulator(peimar.MODBUS_REGISTERS, {"solarPower": 1.5}).start()
+    bridge = make_bridge(plants=[{"plant_uid": "PLANT", "device_sn": "SN1", "source": "modbus",
+                                  "modbus_host": "127.0.0.1", "modbus_port": simulatore.port}])
+    dev = bridge.devices[0]
+    bridge.poll_local(dev)
+    bridge.poll_live(dev)
+    assert portal.requests == 0   # Sorgente locale attiva: nessuna richiesta al portale
+
+    simulatore.stop()
+    for _ in range(bridge.LOCAL_MAX_FAILURES):
+        bridge.poll_local(dev)
+    assert bridge.mqttc.messages[-1] == (f"{dev.TOPIC}/availability", "online", True)
+    portal.release()
+    bridge.poll_live(dev)
+    assert portal.by_endpoint["getStoreOrAcDevicePowerInfo"] >= 1
+    assert dev.last_processed_ts == dev.portal_ts
+
+
+def test_discovery_dropped_while_disconnected_is_repeated_on_connect(make_bridge):
+    bridge = make_bridge(outbox_size=0)
+    bridge.mqttc.connected = False   # All'avvio paho non è ancora collegato e non c'è coda
+    bridge.setup_discovery()
+    assert bridge.discovery_pending
+    assert bridge.load_discovery_cache().keys().isdisjoint(bridge.device_discovery)
+
+    bridge.mqttc.connected = True
+    bridge.on_connect(bridge.mqttc, None, None, 0, None)
+    bridge.scheduler.run_pending()
+    assert not bridge.discovery_pending
+    annunciati = {topic for topic, payload, _ in bridge.mqttc.messages if payload}
+    assert set(bridge.device_discovery) <= annunciati
+    assert set(bridge.device_discovery) <= set(bridge.load_discovery_cache())
+
+
+def test_interrupted_daily_backfill_rebuilds_all_months_on_resume(portal, make_bridge):
+    bridge = make_bridge(history_daily=True)
+    dev = bridge.devices[0]
+    today = date.today()
+    salva = bridge.save_daily
+    salvati = []
+
+    def salva_poi_interrompi(*args):
+        salva(*args)
+        salvati.append(1)
+        if len(salvati) == 120:
+            raise KeyboardInterrupt   # Add-on fermato a metà: giorni salvati, storico mensile no
+    bridge.save_daily = salva_poi_interrompi
+    with pytest.raises(KeyboardInterrupt):
+        bridge.sync_history(dev, {}, start_year=today.year - 1)
+    bridge.save_daily = salva
+
+    portal.reset_counters()
+    storia, _ = bridge.sync_history(dev, {}, start_year=today.year - 1)
+    attesi = {(y, m) for y in (today.year - 1, today.year) for m in range(1, 13) if (y, m) <= (today.year, today.month)}
+    assert {(int(y), int(m)) for y in storia for m in storia[y]} == attesi
+    assert storia[str(today.year - 1)]["1"]["final"]
+    assert portal.requests < len(attesi) * 31 - 120   # I giorni già salvati non si riscaricano
+
+
+def test_circuit_breaker_ignores_failures_of_requests_already_in_flight():
+    breaker = peimar.CircuitBreaker(threshold=5, base_delay=30)
+    for _ in range(8):   # Tre richieste parallele falliscono dopo l'apertura
+        breaker.failure()
+    assert breaker.trips == 1 and breaker.failures == 0
+    assert breaker.open_until <= time.time() + 30 * 1.5
+
+    breaker.open_until = 0
+    breaker.check()      # La prova fallisce: l'attesa raddoppia una sola volta
+    breaker.failure()
+    assert breaker.trips == 2 and breaker.is_open()
+
+
+@pytest.mark.parametrize("mode", ["topics", "json"])
+def test_values_lost_while_disconnected_are_published_after_reconnect(portal, make_bridge, mode):
+    bridge = make_bridge(outbox_size=0, publish_mode=mode)
+    dev = bridge.devices[0]
+    bridge.mqttc.connected = False
+    bridge.poll_live(dev)
+    assert dev.published == {}   # Nulla è uscito: nulla va considerato già pubblicato
+
+    bridge.mqttc.connected = True
+    portal.release()
+    bridge.poll_live(dev)
+    topics = {topic for topic, _, _ in bridge.mqttc.messages}
+    if mode == "topics":
+        assert {f"{dev.TOPIC}/pv/power_now", f"{dev.TOPIC}/grid/power"} <= topics
+    else:
+        assert f"{dev.TOPIC}/state" in topics
+    assert "pv/power_now" in dev.published
+
+
+def test_diagnostic_templates_work_with_numeric_serials(make_bridge):
+    bridge = make_bridge(plants=[{"plant_uid": "PLANT", "device_sn": "2050E00358"}])
+    bridge.announce_diagnostics()
+    config = json.loads(bridge.discovery_payloads["homeassistant/sensor/peimar/bridge_2050E00358_data_age/config"])
+    assert config["value_template"] == "{{ value_json['2050E00358_data_age'] }}"
+
+
+def test_months_to_sync_skips_final_months(make_bridge):
+    bridge = make_bridge()
+    storia = {"2025": {"1": {"pv": 1.0, "final": True}, "2": {"pv": 2.0}}}
+    assert bridge.months_to_sync(storia, 2022, date(2025, 4, 10)) == [(2025, 2), (2025, 3), (2025, 4)]
+    assert bridge.months_to_sync({}, 2025, date(2025, 2, 1)) == [(2025, 1), (2025, 2)]
+
+
+def test_monthly_sync_marks_past_months_final_and_skips_them(portal, make_bridge):
+    bridge = make_bridge()
+    dev = bridge.devices[0]
+    today = date.today()
+    storia, _ = bridge.sync_history(dev, {}, start_year=today.year - 1)
+    assert storia[str(today.year - 1)]["1"]["final"]
+    assert not storia[str(today.year)][str(today.month)].get("final")
+
+    portal.reset_counters()
+    bridge.sync_history(dev, storia, start_year=today.year - 1)
+    assert portal.requests == len(bridge.months_to_sync(storia, today.year - 1, today)) <= 2
+
+
+def test_unchanged_values_are_not_republished(portal, make_bridge):
+    bridge = make_bridge()
+    dev = bridge.devices[0]
+    bridge.poll_live(dev)
+    primi = len(bridge.mqttc.messages)
+    assert primi > 10
+
+    portal.release()   # Nuovo dato con gli stessi valori: cambia solo l'orario
+    bridge.poll_live(dev)
+    assert [topic for topic, _, _ in bridge.mqttc.messages[primi:]] == [f"{dev.TOPIC}/status/last_update_time"]
+
+
+def test_deadband_and_max_age(make_bridge):
+    bridge = make_bridge(publish_deadband=5, publish_max_age=600)
+    dev = bridge.devices[0]
+    now = time.time()
+    dev.published = {"pv/power_now": (1000.0, now), "battery/battery_status": ("Carica", now),
+                     "grid/power": (500.0, now - 600)}
+    assert not bridge.should_publish(dev, "pv/power_now", 1040.0, now)   # Entro il 5%
+    assert bridge.should_publish(dev, "pv/power_now", 1060.0, now)
+    assert bridge.should_publish(dev, "battery/battery_status", "Scarica", now)
+    assert bridge.should_publish(dev, "grid/power", 500.0, now)          # Invariato ma troppo vecchio
+
+
+def test_sample_store_append_query_and_downsample(tmp_path):
+    store = peimar.SampleStore(str(tmp_path), ("pv/power_now", "grid/power"))
+    inizio = datetime(2026, 5, 17, 10, 0).timestamp()
+    for i in range(60):   # Un campione ogni 10 s per 10 minuti; la rete manca nei campioni dispari
+        valori = {"pv/power_now": float(i)}
+        if i % 2 == 0:
+            valori["grid/power"] = 100.0
+        assert store.append("SN1", inizio + i * 10, valori)
+    assert not store.append("SN1", inizio + 5, {"pv/power_now": 1.0})   # Fuori ordine: ignorato
+
+    righe = list(store.query("SN1", inizio + 100, inizio + 200))
+    assert [ts - inizio for ts, _ in righe] == list(range(100, 200, 10))
+    assert righe[0][1] == {"pv/power_now": 10.0, "grid/power": 100.0}
+    assert righe[1][1] == {"pv/power_now": 11.0}
+    assert list(store.query("SN1", inizio, inizio + 20, fields=("grid/power",))) == [
+        (inizio, {"grid/power": 100.0}), (inizio + 10, {})]
+
+    medie = store.downsample("SN1", inizio, inizio + 600, 300, ("pv/power_now", "grid/power"))
+    assert medie == [(inizio, {"pv/power_now": 14.5, "grid/power": 100.0}),
+                     (inizio + 300, {"pv/power_now": 44.5, "grid/power": 100.0})]
+
+
+def test_release_predictor_learns_interval_and_backs_off():
+    predictor = peimar.ReleasePredictor(interval=300, lag=15)
+    assert predictor.next_poll(1000) == 1000 + predictor.MIN_RETRY
+    ts = 1_000_000
+    for _ in range(30):   # Il portale rilascia ogni 240 s, visibile 20 s dopo
+        predictor.retry_delay()
+        predictor.observe(ts, ts + 20)
+        ts += 240
+    assert predictor.interval == pytest.approx(240, abs=1)
+    assert predictor.lag == pytest.approx(20, abs=1)
+    assert predictor.next_poll(ts) == pytest.approx(ts - 240 + 240 + 20, abs=2)
+
+    attese = [predictor.retry_delay() for _ in range(12)]
+    assert attese == sorted(attese) and attese[0] == predictor.MIN_RETRY
+    assert max(attese[:10]) <= predictor.MAX_RETRY
+
+
+def test_cache_ttl_and_day_rollover(portal, make_bridge):
+    bridge = make_bridge(fetch_unused_endpoints=True)
+    dev = bridge.devices[0]
+    bridge.fetch_data(dev)
+    bridge.fetch_data(dev)
+    assert portal.by_endpoint["getPlantDetailInfo"] == 1                # In cache per il suo TTL
+    assert portal.by_endpoint["getStoreOrAcDevicePowerInfo"] == 2       # TTL 0: sempre riscaricato
+
+    fetched_at, _ = dev.fetched["plant"]
+    dev.fetched["plant"] = (fetched_at, "2000-01-01")                   # Scaricato ieri
+    bridge.fetch_data(dev)
+    assert portal.by_endpoint["getPlantDetailInfo"] == 2
+
+    bridge.login()                                                      # Nuova sessione: cache svuotata
+    bridge.fetch_data(dev)
+    assert portal.by_endpoint["getPlantDetailInfo"] == 3
+
+
+def test_ingest_raw_pages_until_checkpoint(portal, make_bridge):
+    bridge = make_bridge(raw_ingest=True)
+    dev = bridge.devices[0]
+    mezzogiorno = datetime.combine(date.today(), dtime(12)).timestamp()
+    portal.update_ts = int(mezzogiorno * 1000)
+    portal.raw_records = 250   # Tre pagine da RAW_PAGE_SIZE, un record ogni 5 minuti
+    bridge.save_raw_checkpoint(dev, mezzogiorno - 120 * 300)
+
+    assert bridge.ingest_raw(dev) == 120
+    assert portal.by_endpoint["findRawdataPageList"] == 2               # Ci si ferma al record già acquisito
+    assert bridge.load_raw_checkpoint(dev) == mezzogiorno
+    campioni = list(bridge.sample_store.query(dev.DEVICE_SN, mezzogiorno - 120 * 300, mezzogiorno + 1))
+    assert len(campioni) == 120 and campioni[-1][0] == mezzogiorno
+
+    portal.reset_counters()
+    assert bridge.ingest_raw(dev) == 0
+    assert portal.requests == 1
+
+
+def test_warm_start_republishes_recent_snapshot(portal, make_bridge):
+    bridge = make_bridge()
+    dev = bridge.devices[0]
+    bridge.poll_live(dev)
+    bridge.save_snapshot(dev)
+
+    riavviato = make_bridge()
+    portal.reset_counters()
+    nuovo = riavviato.devices[0]
+    riavviato.warm_start(nuovo)
+    assert portal.requests == 0
+    assert nuovo.last_processed_ts == dev.last_processed_ts
+    assert {topic for topic, _, _ in riavviato.mqttc.messages} >= {f"{nuovo.TOPIC}/pv/power_now", f"{nuovo.TOPIC}/grid/power"}
+
+    vecchio = make_bridge()
+    vecchio.SNAPSHOT_MAX_AGE = -1   # Ultimo stato troppo vecchio: non si ripubblica
+    vecchio.warm_start(vecchio.devices[0])
+    assert vecchio.mqttc.messages == []